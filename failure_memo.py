@@ -0,0 +1,69 @@
+"""
+Remembers data sets that could not be processed, so that they are not
+opened and parsed again on every scan.
+"""
+
+import os, shelve, time
+
+from logger import Logger
+
+
+class FailureMemo:
+    """
+    A persistent record of failures. The constructor accepts the path
+    of the shelve file to keep the records in, which is created if
+    necessary, and the number of seconds <retry_after> after which a
+    failed data set should be tried again. If that is zero, a data set
+    is only tried again after it has changed.
+
+    Records are keyed by path and only apply while the modification
+    time and size on disk match the ones stored. Each record also holds
+    the stage at which processing failed and the reason given.
+    """
+
+    def __init__(self, location, retry_after = 0):
+        self.log = Logger()
+        self.location = location
+        self.retry_after = retry_after
+        self.db = shelve.open(location)
+
+    def lookup(self, path):
+        """
+        Returns the failure record for <path> as a dictionary if it is
+        still valid, or None otherwise.
+        """
+        rec = self.db.get(path)
+        if rec is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if rec['mtime'] != stat.st_mtime or rec['size'] != stat.st_size:
+            return None
+        if 0 < self.retry_after < time.time() - rec['time']:
+            return None
+        return rec
+
+    def add(self, path, stage, reason):
+        """
+        Records that processing of <path> failed at the given stage.
+        """
+        stat = os.stat(path)
+        self.db[path] = { 'mtime' : stat.st_mtime,
+                          'size'  : stat.st_size,
+                          'time'  : time.time(),
+                          'stage' : stage,
+                          'reason': reason }
+
+    def remove(self, path, stage = None):
+        """
+        Forgets the failure recorded for <path>, if any. If <stage> is
+        given, only a failure at that stage is forgotten.
+        """
+        rec = self.db.get(path)
+        if rec is not None and stage in (None, rec['stage']):
+            del self.db[path]
+
+    def close(self):
+        self.db.close()
@@ -13,6 +13,13 @@ else:
     SEEK_END = 2
 
 
+class CacheLimitExceeded(RuntimeError):
+    """
+    Raised when a read extends beyond the 'cache_limit' of a FileCache.
+    """
+    pass
+
+
 class FileCache:
     """
     This class provides cached read-only access to files on the local
@@ -119,7 +126,7 @@ class FileCache:
         
         # -- never read beyond a certain point
         if size > self.cache_limit:
-            raise RuntimeError("Cache limit exceeded.")
+            raise CacheLimitExceeded("Cache limit exceeded.")
         
         # -- keep the file system access counter up to date
         if len(self.buffer) == 0:
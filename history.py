@@ -588,10 +588,24 @@ class History:
         elif eligible:
             return eligible[0]
 
+    def add_to_data_file(self, key, value):
+        # -- record additional information on the source file
+        main = self.main_process()
+        if main and main.data_file is not None:
+            main.data_file[key] = value
+
 
-def as_json(history):
-    return json.dumps(list(p.record for p in history.processes),
-                      sort_keys = True, indent = 4)
+def as_json(history, compact = False):
+    return ''.join(json_chunks(history, compact))
+
+# Produces the JSON form of a history piece by piece, without building
+# the whole text in memory. The compact form has no whitespace at all.
+def json_chunks(history, compact = False):
+    if compact:
+        encoder = json.JSONEncoder(sort_keys = True, separators = (',', ':'))
+    else:
+        encoder = json.JSONEncoder(sort_keys = True, indent = 4)
+    return encoder.iterencode(list(p.record for p in history.processes))
 
 def set_xyz(target, name, vec):
     if len(vec) >= 3:
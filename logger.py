@@ -1,4 +1,4 @@
-import sys
+import sys, threading
 
 LOGGER_TRACE   = 0
 LOGGER_INFO    = 1
@@ -30,6 +30,7 @@ class Logger:
             self.stream = sys.stderr
             self.priority = LOGGER_WARNING
             self._stack = []
+            self._lock = threading.RLock()
 
     @property
     def tag(self):
@@ -55,10 +56,15 @@ class Logger:
     def write(self, text, priority = LOGGER_INFO):
         if priority >= self.priority:
             pre = "  " * self.level + self.prefix(priority, self.tag)
-            self.stream.write("\n".join(pre + s for s in text.split("\n") if s))
-            if text.endswith("\n"):
-                self.stream.write("\n")
-            self.stream.flush()
+            self._lock.acquire()
+            try:
+                self.stream.write("\n".join(pre + s
+                                            for s in text.split("\n") if s))
+                if text.endswith("\n"):
+                    self.stream.write("\n")
+                self.stream.flush()
+            finally:
+                self._lock.release()
         
     def writeln(self, text, priority = LOGGER_INFO):
         self.write(text + "\n", priority = priority)
@@ -3,6 +3,7 @@ Functions to convert a two-dimensional numpy array into image data
 ready to be written to file. The main entry point is make_image().
 """
 
+import json, zipfile
 from cStringIO import StringIO
 
 from numpy import *
@@ -15,16 +16,29 @@ BLACK_AND_WHITE   = 'black_and_white'
 COLOR_CODED       = 'color_coded'
 COLOR_CODED_FIXED = 'color_coded_fixed'
 
+# -- supported image codecs with their file extensions and PIL formats
+CODECS = { 'png':  ('.png',  'PNG'),
+           'jpeg': ('.jpg',  'JPEG'),
+           'webp': ('.webp', 'WEBP') }
+
+# -- descriptor for Deep Zoom tile pyramids
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+       TileSize="%d" Overlap="0" Format="%s">
+  <Size Width="%d" Height="%d"/>
+</Image>
+"""
+
 
 def convert_grayscale(data, mask, lo, hi):
     """
     Converts two-dimensional grayscale data into an image object. Input
     should be of type 'uint16'.
     
-    The numpy array <data> contains the (masked) raw data. A
-    second array <mask> of equal dimensions is set to 1 for
-    portions of the data that were suppressed. At any point at most
-    one of these arrays should be non-zero.
+    The numpy array <data> contains the raw data. A second array
+    <mask> of equal dimensions, boolean or integral, is non-zero for
+    portions of the data that were suppressed. Data values at those
+    positions are ignored and treated as zero.
     
     The numbers <lo> and <hi> mark the range of relevant data
     values. For tomo images, contrast is stretched linearly so that
@@ -35,13 +49,46 @@ def convert_grayscale(data, mask, lo, hi):
     
     # -- stretch contrast linearly between lo and hi
     f = float(0xffff) / (hi - lo) / 256
-    output = minimum((maximum(data, lo) - lo) * f, 255)
-    # -- convert to unsigned byte and compose with mask
-    output = (output.astype(uint8) | (mask.astype(uint8) * 80))
+    if data.dtype == uint16:
+        # -- a lookup table covers all possible input values
+        table = stretched(arange(0x10000, dtype = uint16), lo, f)
+        output = table[data]
+        zero = table[0]
+    else:
+        output = stretched(data, lo, f)
+        zero = stretched(zeros(1, data.dtype), lo, f)[0]
+    # -- compose with mask
+    output[as_mask(mask)] = zero | 80
     # -- convert to image
     return Image.fromarray(output, 'L')
 
 
+def stretched(data, lo, f):
+    """
+    Does the contrast stretch for convert_grayscale() and returns the
+    result as an array of unsigned bytes. Floating point input is
+    processed in its own precision within a single temporary array.
+    """
+    
+    tmp = maximum(data, lo)
+    tmp -= lo
+    if tmp.dtype.kind != 'f':
+        tmp = tmp * f
+    else:
+        tmp *= f
+    minimum(tmp, 255, tmp)
+    return tmp.astype(uint8)
+
+
+def as_mask(mask):
+    """
+    Converts <mask> into a boolean array, if necessary.
+    """
+    if mask.dtype == bool:
+        return mask
+    return mask != 0
+
+
 def convert_black_and_white(data, mask):
     """
     Converts two-dimensional data into a black-and-white image.
@@ -50,10 +97,48 @@ def convert_black_and_white(data, mask):
     
     The results is an 8-bit grayscale PIL.Image object.
     """
-    output = (mask * 80 + where(data > 0, 0xff, 0)).astype(uint8)
+    output = zeros(data.shape, uint8)
+    output[data > 0] = 0xff
+    output[as_mask(mask)] = 80
     return Image.fromarray(output, 'L')
 
 
+# -- lookup tables for color coding, by bit width of the input type
+COLOR_TABLES = {}
+
+def color_tables(bits):
+    """
+    Returns the lookup tables used by convert_color_coded(), mapping
+    each 16-bit value to an opaque RGBA color. The first table covers
+    the bit shuffling scheme alone, the second also the fixed palette.
+
+    Bits are shuffled within the input type, so that for input types
+    narrower than 24 bits, only those moved to positions below <bits>
+    are used.
+    """
+    
+    if bits in COLOR_TABLES:
+        return COLOR_TABLES[bits]
+    
+    # -- translation map to turn label bits into RGB bits
+    bmap = [ 7, 15, 23, 6, 14, 22, 5, 13, 21, 4, 12, 20, 3, 11, 19 ]
+    # -- map low phase values to colors: green, red, blue, etc.
+    colormap = [ 0,
+                 0x00ff00, 0x0000ff, 0xff0000, 0x00ffff, 0xffff00,
+                 0x007f00, 0x00007f, 0x7f0000, 0x007f7f, 0x7f7f00 ]
+    
+    values = arange(0x10000, dtype = uint32)
+    shuffled = zeros(values.shape, uint32) + 0xff000000
+    for i in range(15):
+        if bmap[i] < bits:
+            shuffled |= ((values >> i) & 1) << bmap[i]
+    fixed = shuffled.copy()
+    fixed[:len(colormap)] = array(colormap, uint32) | 0xff000000
+    
+    COLOR_TABLES[bits] = (shuffled, fixed)
+    return shuffled, fixed
+
+
 def convert_color_coded(data, mask, use_fixed = False):
     """
     Converts two-dimensional data into an image object by applying
@@ -69,25 +154,21 @@ def convert_color_coded(data, mask, use_fixed = False):
     The results is an RGBA-encoded PIL.Image object.
     """
     
-    # -- fill output array with opaque black pixels
-    output = zeros(data.shape, uint32) + 0xff000000
+    # -- look up colors for the 16 least significant bits
+    (shuffled, fixed) = color_tables(8 * data.dtype.itemsize)
+    index = data & 0xffff
+    if use_fixed:
+        output = fixed[index]
+        # -- the palette only applies to values that fit into 16 bits
+        if data.dtype not in (uint8, uint16):
+            odd = (data < 0) | (data > 0xffff)
+            if odd.any():
+                output[odd] = where(data[odd] < 0, 0xff000000,
+                                    shuffled[index[odd]])
+    else:
+        output = shuffled[index]
     # -- apply mask
-    output[mask != 0] |= 0x505050
-    
-    if (use_fixed):
-        # -- map low phase values to colors: green, red, blue, etc.
-        colormap = [ 0,
-                     0x00ff00, 0x0000ff, 0xff0000, 0x00ffff, 0xffff00,
-                     0x007f00, 0x00007f, 0x7f0000, 0x007f7f, 0x7f7f00 ]
-        for i in range(1, len(colormap)):
-            output[data == i] |= colormap[i]
-        data = where(data < len(colormap), 0, data)
-
-    # -- translation map to turn label bits into RGB bits
-    bmap = [ 7, 15, 23, 6, 14, 22, 5, 13, 21, 4, 12, 20, 3, 11, 19 ]
-    # -- shuffle input bits according to bmap
-    for i in range(15):
-        output |= ((data >> i) & 1) << bmap[i]
+    output[as_mask(mask)] = fixed[0] | 0x505050
 
     # -- convert to image
     return Image.fromarray(output, 'RGBA')
@@ -105,36 +186,104 @@ def make_image(a, lo, hi, mask_val, mode, thumb_size = None, info = {}):
     binary string.
     """
     
-    # -- separate mask and data
-    data = where(a == mask_val, 0, a)
-    mask = where(a == mask_val, 1, 0)
+    # -- return the data string encoding the image
+    return image_as_png(convert_image(a, lo, hi, mask_val, mode),
+                        thumb_size, info)
+
+def image_encoders(a, lo, hi, mask_val, mode, thumb_sizes = (None,),
+                   info = {}, compress_level = None, codecs = None,
+                   tiles = None):
+    """
+    Converts the array <a> into an image as for make_image(), but
+    leaves the encoding to a list of functions, one for each entry of
+    <thumb_sizes>, which take no arguments and return the encoded image
+    when called. These functions may be called in any order and from
+    several threads at once. Each thumbnail is made from a copy of the
+    full-size image, so that the results are the same as for separate
+    calls to make_image(). If <compress_level> is given, it sets the
+    zlib compression level for the PNG encoder.
+
+    The list <codecs>, if given, holds a (codec, quality) pair for each
+    entry of <thumb_sizes>, as accepted by encode_image(). Otherwise, all
+    images are PNG-encoded. The codec used is recorded in the metadata
+    of each image.
+
+    If <tiles> is given as a tuple (name, tile_size, codec, quality), a
+    further function is appended to the list, which produces a tile
+    pyramid of the full-size image as described for tile_pyramid().
+    """
+    
+    image = convert_image(a, lo, hi, mask_val, mode)
+    for (key, val) in info.items():
+        image.info[key] = str(val)
+    if codecs is None:
+        codecs = [('png', None)] * len(thumb_sizes)
+    result = list(image_encoder(image, size, compress_level, codec, quality)
+                  for (size, (codec, quality)) in zip(thumb_sizes, codecs))
+    if tiles is not None:
+        result.append(tile_encoder(image, compress_level, *tiles))
+    return result
+
+def image_encoder(image, size, compress_level, codec = 'png', quality = None):
+    info = { 'image-codec': codec }
+    if quality is not None:
+        info['image-quality'] = quality
+
+    def encode():
+        if size is None:
+            im = image
+        else:
+            im = image.copy()
+            im.thumbnail(size, Image.ANTIALIAS)
+        return encode_image(im, codec, quality, compress_level, info)
+    return encode
+
+def tile_encoder(image, compress_level, name, tile_size, codec = 'png',
+                 quality = None):
+    return lambda: tile_pyramid(image, name, tile_size, codec, quality,
+                                compress_level)
+
+def convert_image(a, lo, hi, mask_val, mode):
+    """
+    Does the work for make_image() up to the point where a PIL.Image
+    object is produced.
+    """
+    
+    # -- find masked entries, leaving the data untouched
+    mask = (a == mask_val)
     
     # -- convert into PIL.Image object depending on format
     if mode == GRAYSCALE:
-        image = convert_grayscale(data, mask, lo, hi)
+        image = convert_grayscale(a, mask, lo, hi)
     elif mode == BLACK_AND_WHITE:
-        image = convert_black_and_white(data, mask)
+        image = convert_black_and_white(a, mask)
     elif mode == COLOR_CODED:
-        image = convert_color_coded(data, mask, False)
+        image = convert_color_coded(a, mask, False)
     elif mode == COLOR_CODED_FIXED:
-        image = convert_color_coded(data, mask, True)
+        image = convert_color_coded(a, mask, True)
     else:
         raise "unknown mode: '%s'" % mode
 
+    return image
+
+def make_dummy(text, width = 256, height = 256, thumb_size = None,
+               codec = 'png', quality = None):
+    image = dummy_image(text, width, height)
+    if thumb_size is not None:
+        image.thumbnail(thumb_size, Image.ANTIALIAS)
+
     # -- return the data string encoding the image
-    return image_as_png(image, thumb_size, info)
+    return encode_image(image, codec, quality)
 
-def make_dummy(text, width = 256, height = 256, thumb_size = None):
+def dummy_image(text, width = 256, height = 256):
     from PIL import ImageDraw
 
     image = Image.new("RGB", (width, height), 'gray')
     draw = ImageDraw.Draw(image)
     draw.text((64, 64), text, fill = 'black')
+    return image
 
-    # -- return the data string encoding the image
-    return image_as_png(image, thumb_size)
-
-def image_as_png(image, thumb_size = None, info = {}):
+def image_as_png(image, thumb_size = None, info = {}, compress_level = None):
     for (key, val) in info.items():
         image.info[key] = str(val)
     if thumb_size is not None:
@@ -142,12 +291,125 @@ def image_as_png(image, thumb_size = None, info = {}):
 
     output = StringIO()
     #image.save(output, "PNG")
-    pngsave(image, output)
+    pngsave(image, output, compress_level)
     content = output.getvalue();
     output.close()
     
     return content
 
+def encode_image(image, codec = 'png', quality = None, compress_level = None,
+                 info = {}):
+    """
+    Encodes <image> in the format named by <codec>, one of the keys of
+    CODECS, and returns the result as a binary string. The metadata in
+    image.info is embedded together with the entries of <info>, as text
+    chunks for PNG, or else as a JSON object in the EXIF image
+    description. The <quality> only applies to the lossy codecs and the
+    <compress_level> only to PNG. Writing EXIF data requires Pillow 6.0
+    or later, so see 'codec_available()' before using a codec other
+    than PNG.
+    """
+    
+    meta = dict(image.info)
+    for (key, val) in info.items():
+        meta[key] = str(val)
+
+    output = StringIO()
+    if codec == 'png':
+        pngsave(image, output, compress_level, meta)
+    else:
+        options = {}
+        if quality is not None:
+            options['quality'] = quality
+        # -- tag 0x010e is the EXIF image description
+        exif = Image.Exif()
+        exif[0x010e] = json.dumps(dict((k, v) for (k, v) in meta.items()
+                                       if isinstance(v, basestring)))
+        if codec == 'jpeg' and image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        # -- offsets count from the TIFF header, which takes 8 bytes
+        image.save(output, CODECS[codec][1], exif = exif.tobytes(8),
+                   **options)
+    content = output.getvalue()
+    output.close()
+    
+    return content
+
+def tile_pyramid(image, name, tile_size = 256, codec = 'png', quality = None,
+                 compress_level = None):
+    """
+    Cuts <image> into a Deep Zoom tile pyramid and returns it as a zip
+    archive in a binary string. The archive holds the descriptor
+    '<name>.dzi' and for each level a directory '<name>_files/<level>'
+    of tiles with at most <tile_size> pixels on either side, named
+    '<column>_<row>' plus the extension for <codec>.
+
+    The top level holds the image at full size and each level below it
+    is made by halving the one above, down to a single pixel at level
+    zero, so that the image is scaled in one pass. The tiles carry no
+    metadata of their own.
+    """
+    
+    (width, height) = image.size
+    top = 0
+    while (1 << top) < max(width, height):
+        top += 1
+    ext = CODECS[codec][0]
+
+    output = StringIO()
+    archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED)
+    level = image
+    for n in range(top, -1, -1):
+        (w, h) = level.size
+        for y in range(0, h, tile_size):
+            for x in range(0, w, tile_size):
+                tile = level.crop((x, y, min(x + tile_size, w),
+                                   min(y + tile_size, h)))
+                tile.info = {}
+                archive.writestr("%s_files/%d/%d_%d%s" % (name, n,
+                                                          x / tile_size,
+                                                          y / tile_size, ext),
+                                 encode_image(tile, codec, quality,
+                                              compress_level))
+        if n > 0:
+            level = level.resize(((w + 1) / 2, (h + 1) / 2), Image.ANTIALIAS)
+    archive.writestr(name + '.dzi',
+                     DZI_TEMPLATE % (tile_size, ext[1:], width, height))
+    archive.close()
+    content = output.getvalue()
+    output.close()
+
+    return content
+
+def codec_available(codec):
+    """
+    Checks whether the installed PIL can encode images with <codec>.
+    Codecs other than PNG carry their metadata as EXIF data, which needs
+    the Image.Exif class introduced in Pillow 6.0.
+    """
+    Image.init()
+    if codec != 'png' and not hasattr(Image, 'Exif'):
+        return False
+    return codec in CODECS and CODECS[codec][1] in Image.SAVE
+
+def parse_codec(spec):
+    """
+    Splits a codec specification of the form 'CODEC' or 'CODEC:QUALITY'
+    into a pair (codec, quality), with quality None if not given.
+    Raises a ValueError if the specification is invalid.
+    """
+    
+    (codec, sep, quality) = spec.lower().partition(':')
+    if codec not in CODECS:
+        raise ValueError("unknown image codec: '%s'" % codec)
+    if not sep:
+        return (codec, None)
+    if codec == 'png':
+        raise ValueError("PNG is lossless and takes no quality setting")
+    if not quality.isdigit() or not 1 <= int(quality) <= 100:
+        raise ValueError("image quality must be between 1 and 100")
+    return (codec, int(quality))
+
 
 #
 # wrapper around PIL 1.1.6 Image.save to preserve PNG metadata
@@ -155,7 +417,7 @@ def image_as_png(image, thumb_size = None, info = {}):
 # public domain, Nick Galbreath
 # http://blog.modp.com/2007/08/python-pil-and-png-metadata-take-2.html
 #                                                                                                                                       
-def pngsave(im, file):
+def pngsave(im, file, compress_level = None, info = None):
     # these can be automatically added to Image.info dict
     # they are not user-added metadata
     reserved = ('interlace', 'gamma', 'dpi', 'transparency', 'aspect')
@@ -165,9 +427,14 @@ def pngsave(im, file):
     meta = PngImagePlugin.PngInfo()
 
     # copy metadata into new object
-    for k,v in im.info.iteritems():
+    if info is None:
+        info = im.info
+    for k,v in info.iteritems():
         if k in reserved: continue
         meta.add_text(k, v, 0)
 
     # and save
-    im.save(file, "PNG", pnginfo=meta)
+    if compress_level is None:
+        im.save(file, "PNG", pnginfo=meta)
+    else:
+        im.save(file, "PNG", pnginfo=meta, compress_level=compress_level)
@@ -7,9 +7,12 @@ Currently supported data types are tomo, segmented and labels. If the
 data is split into multiple files, those must sit in a common directory
 and that directory given as the path argument.
 
-Slices are taken through the center of the volume. If either of the
+By default, slices are taken through the center of the volume, but
+any number of slices, slabs and projections can be requested instead,
+all of which are filled in a single pass through the data. If either of the
 dimensions for a slice image would be less than 10, that slice is
-suppressed. Image output is in .png format.
+suppressed. Image output is in .png format, unless a different codec is
+chosen for some kind of image.
 
 Typical usage:
     for (data, name, action) in slices(path):
@@ -21,13 +24,14 @@ Typical usage:
 (Requires Python 2.6 or higher.)
 """
 
-import os, os.path, re, struct, sys
+import hashlib, json, os, os.path, re, struct, sys
 import numpy
 import bz2
 
 from logger import Logger, LOGGER_INFO, LOGGER_WARNING
 import make_image
 from nc3files import datafiles, nc3info
+from thread_pool import ThreadPool
 
 
 class Histogram:
@@ -59,12 +63,15 @@ class Histogram:
         <slice>.
         """
         
-        # -- process the new data
-        tmp = (slice.flatten() - self.offset) / self.binsize
-        flat = numpy.array(tmp, dtype = 'uint16')
-        mask = (flat == self.mask_value) | (flat < 0) | (flat > 0xffff)
-        new_masked = flat[mask].size
-        new_counts = numpy.bincount(numpy.where(mask, 0, flat))
+        # -- separate masked entries, comparing in the original type
+        data = slice.ravel()
+        mask = (data == self.mask_value)
+        new_masked = int(mask.sum())
+
+        # -- bin the remaining non-negative entries
+        tmp = (data[~mask] - self.offset) / self.binsize
+        flat = numpy.array(tmp[tmp >= 0], dtype = 'uint16')
+        new_counts = numpy.bincount(flat, minlength = 1)
         
         # -- update the frequency count, resizing if necessary
         s = max(self.counts.size, new_counts.size)
@@ -79,28 +86,232 @@ class Histogram:
         self.total  += new_masked + int(new_counts.sum())
 
 
+class DataDigest:
+    """
+    Computes a checksum over the raw volume data as it is read. The
+    constructor accepts the name of the algorithm to use, which is
+    either 'xxhash' (requires the optional xxhash package) or any name
+    understood by hashlib, such as 'md5' or 'sha256'.
+    """
+
+    def __init__(self, algorithm = 'md5'):
+        if algorithm == 'xxhash':
+            import xxhash
+            self._hash = xxhash.xxh64()
+        else:
+            self._hash = hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.count = 0
+        self.complete = False
+
+    def update(self, buffer):
+        self._hash.update(buffer)
+        self.count += len(buffer)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    @property
+    def value(self):
+        """
+        The checksum in the form '<algorithm>:<hexdigest>', or None if
+        the volume data has not been read completely.
+        """
+        if self.complete:
+            return "%s:%s" % (self.algorithm, self.hexdigest())
+
+
+class VolumeStats:
+    """
+    Summarizes the histogram made while slicing a volume, so that
+    common statistics are available without reading the data again.
+    The constructor accepts the <percentiles> to report and the largest
+    number of distinct phases <max_phases> for which voxel counts are
+    listed individually.
+
+    Once the volume has been read completely, the attribute 'record'
+    holds a dictionary with the number of voxels counted, the fraction
+    of those masked, the minimum, maximum and percentiles of the other
+    values and, if phases were requested, the number of voxels for each
+    value present. Values are those of the histogram bins, so they are
+    approximate for floating point data.
+    """
+
+    PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+    def __init__(self, percentiles = PERCENTILES, max_phases = 256):
+        self.percentiles = percentiles
+        self.max_phases = max_phases
+        self.record = None
+
+    def update(self, histogram, phases = False):
+        """
+        Computes the record from the Histogram instance <histogram>,
+        including voxel counts per value if <phases> is true.
+        """
+        counts = histogram.counts
+        used = numpy.flatnonzero(counts)
+        value = lambda i: number(histogram.offset + i * histogram.binsize)
+        record = { 'voxels': histogram.total,
+                   'masked': (float(histogram.masked) / histogram.total
+                              if histogram.total else 0.0) }
+        if used.size:
+            cumulative = numpy.cumsum(counts)
+            unmasked = histogram.total - histogram.masked
+            record['min'] = value(used[0])
+            record['max'] = value(used[-1])
+            record['percentiles'] = dict(
+                (str(p), value(numpy.searchsorted(cumulative,
+                                                  p * unmasked / 100.0)))
+                for p in self.percentiles)
+        if phases:
+            record['phase_count'] = int(used.size)
+            if used.size <= self.max_phases:
+                record['phases'] = dict((str(value(i)), int(counts[i]))
+                                        for i in used)
+        self.record = record
+
+    @property
+    def value(self):
+        """
+        The record in compact JSON form, or None if there is none.
+        """
+        if self.record is not None:
+            return json.dumps(self.record, sort_keys = True,
+                              separators = (',', ':'))
+
+
+def number(x):
+    """
+    Converts a numpy scalar into a plain int or float, as needed by
+    json.
+    """
+    if float(x) == int(x):
+        return int(x)
+    return float(x)
+
+
 class Slice:
-    def __init__(self, size, type, axis, pos):
+    """
+    A plane through the volume perpendicular to the given <axis> at
+    position <pos>, filled in one z slice at a time.
+
+    If a <thickness> greater than one is given, the plane combines a
+    slab of that many consecutive planes centered at <pos>, which is cut
+    off at the boundaries of the volume. The <method> for combining them
+    is one of 'mean', 'max' or 'min', so that a slab covering the whole
+    volume gives a projection. Entries equal to <mask_value> are left
+    out, and positions with no other entries are masked.
+    """
+
+    def __init__(self, size, type, axis, pos, thickness = 1,
+                 mask_value = None, method = 'mean'):
         self.axis = axis.lower()
         self.pos  = pos
+        self.thickness = thickness
+        self.mask_value = mask_value
+        self.method = method
         self.slice_dims = {'x': (size[2], size[1]),
                            'y': (size[2], size[0]),
                            'z': (size[1], size[0]) }[self.axis]
         self.content = numpy.zeros(self.slice_dims, type)
 
-    def update(self, z_slice, z_pos):
+        # -- the range of planes covered
+        extent = size['xyz'.index(self.axis)]
+        self.first = max(pos - (thickness - 1) / 2, 0)
+        self.last  = min(pos - (thickness - 1) / 2 + thickness, extent)
+
+        # -- placeholder for masked entries and accumulators for z slabs
+        if method == 'mean':
+            self.fill = 0
+        else:
+            limits = (numpy.finfo if self.content.dtype.kind == 'f'
+                      else numpy.iinfo)(self.content.dtype)
+            self.fill = limits.min if method == 'max' else limits.max
+        if thickness > 1 and self.axis == 'z':
+            if method == 'mean':
+                self.total = numpy.zeros(self.slice_dims, numpy.float64)
+            else:
+                self.total = numpy.empty(self.slice_dims, type)
+                self.total.fill(self.fill)
+            self.count = numpy.zeros(self.slice_dims, numpy.int32)
+
+    def update(self, z_slice, z_pos, y_pos = 0):
         """
         Updates this slices with data from the array <z_slice>, which
-        is taken to be at z = <z_pos>.
+        is taken to be at z = <z_pos>. The array may hold just a range
+        of rows of the full z slice, starting at y = <y_pos>. Rows must
+        be passed in order.
         """
 
-        if self.axis == 'x':
-            self.content[z_pos, :] = z_slice[:, self.pos]
+        (y0, y1) = (y_pos, y_pos + z_slice.shape[0])
+        if self.thickness > 1:
+            self.update_slab(z_slice, z_pos, y0, y1)
+        elif self.axis == 'x':
+            self.content[z_pos, y0:y1] = z_slice[:, self.pos]
         elif self.axis == 'y':
-            self.content[z_pos, :] = z_slice[self.pos, :]
+            if y0 <= self.pos < y1:
+                self.content[z_pos, :] = z_slice[self.pos - y0, :]
         elif self.axis == 'z':
             if z_pos == self.pos:
-                self.content[:, :] = z_slice[:, :]
+                self.content[y0:y1, :] = z_slice[:, :]
+
+    def update_slab(self, z_slice, z_pos, y0, y1):
+        if self.axis == 'x':
+            block = z_slice[:, self.first:self.last]
+            self.content[z_pos, y0:y1] = self.result(*self.reduce(block, 1))
+        elif self.axis == 'y':
+            (lo, hi) = (max(self.first, y0), min(self.last, y1))
+            if lo < hi:
+                (value, count) = self.reduce(z_slice[lo - y0:hi - y0, :], 0)
+                # -- rows of the slab may come in several pieces
+                if lo == self.first:
+                    self.row = (value, count)
+                else:
+                    self.combine(self.row[0], self.row[1], value, count)
+                self.content[z_pos, :] = self.result(*self.row)
+        elif self.first <= z_pos < self.last:
+            block = z_slice[:, :, numpy.newaxis]
+            (total, count) = (self.total[y0:y1], self.count[y0:y1])
+            self.combine(total, count, *self.reduce(block, 2))
+            self.content[y0:y1, :] = self.result(total, count)
+
+    def combine(self, total, count, value, new_count):
+        """
+        Merges partial results into the arrays <total> and <count>.
+        """
+        if self.method == 'mean':
+            total += value
+        elif self.method == 'max':
+            numpy.maximum(total, value, total)
+        else:
+            numpy.minimum(total, value, total)
+        count += new_count
+
+    def reduce(self, block, axis):
+        """
+        Combines the entries of <block> along the given axis, leaving
+        out masked ones. Returns the sums for the 'mean' method, or else
+        the extreme values, together with the numbers of entries used.
+        """
+        valid = (block != self.mask_value)
+        value = numpy.where(valid, block, self.fill)
+        if self.method == 'mean':
+            value = value.sum(axis, dtype = numpy.float64)
+        elif self.method == 'max':
+            value = value.max(axis)
+        else:
+            value = value.min(axis)
+        return (value, valid.sum(axis))
+
+    def result(self, value, count):
+        if self.method == 'mean':
+            value = value / numpy.maximum(count, 1)
+            if self.content.dtype.kind != 'f':
+                value = numpy.rint(value)
+        result = value.astype(self.content.dtype)
+        result[count == 0] = self.mask_value
+        return result
 
 
 def get_attribute(info, var, name):
@@ -176,14 +387,15 @@ def find_variable(path):
             return volume_variable(info, v)
 
 
-def z_slices(variable, path):
+def z_slices(variable, path, digest = None):
     """
     A generator method that yields constant z slices corresponding
     to the variable <var> from the NetCDF file located at <path>.
         
     Each value produced is a pair containing the z coordinate of
     the slice and a two-dimensional numpy array containing the
-    extracted data.
+    extracted data. If <digest> is given, the raw data read is passed
+    to its update() method.
 
     Usage example:
         
@@ -191,6 +403,19 @@ def z_slices(variable, path):
             ... # do something with data
     """
 
+    for tmp in z_tiles(variable, path, digest):
+        yield (tmp[0],) + tmp[2:]
+
+
+def z_tiles(variable, path, digest = None, rows = None):
+    """
+    Works like z_slices(), but reads each z slice in pieces of at most
+    <rows> full rows, so that memory use does not depend on the size of
+    the slices. Each value produced is a triple containing the z and
+    y coordinates of the piece and the data as a two-dimensional array.
+    By default, pieces are whole z slices.
+    """
+
     info = nc3info(path)
 
     for var in info.variables:
@@ -203,6 +428,7 @@ def z_slices(variable, path):
         raise RuntimeError("variable mismatch between files")
 
     (x, y, z) = variable['size']
+    rows = min(rows or y, y)
 
     z_range = get_attribute(info, var, 'zdim_range')
     if z_range is None:
@@ -210,7 +436,7 @@ def z_slices(variable, path):
     else:
         z_range = range(z_range[0], z_range[1] + 1)
 
-    bytes_per_slice = x * y * var.element_size
+    bytes_per_row = x * var.element_size
     offset = var.data_start
 
     if path.endswith('.bz2'):
@@ -219,16 +445,59 @@ def z_slices(variable, path):
         fp = open(path, "rb")
     fp.seek(var.data_start)
     for z in z_range:
-        buffer = fp.read(bytes_per_slice)
-        if len(buffer) < bytes_per_slice:
-            yield (z, None, "insufficient data")
-            break
-        data = numpy.fromstring(buffer, variable['big_endian_type'])
-        data.shape = (y, x)
-        yield (z, data)
+        for y0 in range(0, y, rows):
+            n = min(rows, y - y0)
+            buffer = fp.read(n * bytes_per_row)
+            if len(buffer) < n * bytes_per_row:
+                yield (z, y0, None, "insufficient data")
+                fp.close()
+                return
+            if digest is not None:
+                digest.update(buffer)
+            data = numpy.fromstring(buffer, variable['big_endian_type'])
+            data.shape = (n, x)
+            yield (z, y0, data)
     fp.close()
 
 
+def volume_checksum(path, algorithm = 'md5', memory_budget = 0):
+    """
+    Computes the checksum of the volume data for the data set at <path>
+    in the same way slices() does when given a DataDigest, but without
+    making any slices. Returns None if no complete volume was found.
+    """
+
+    entries = datafiles(path)
+    if not entries:
+        return None
+    var = find_variable(entries[0])
+    if var is None:
+        return None
+
+    digest = DataDigest(algorithm)
+    rows = tile_rows(var, memory_budget)
+    for filename in entries:
+        for tmp in z_tiles(var, filename, digest, rows):
+            if tmp[2] is None:
+                return None
+    digest.complete = True
+    return digest.value
+
+
+def tile_rows(var, memory_budget):
+    """
+    Returns the number of rows of a z slice of the volume variable
+    <var> which can be processed at once within <memory_budget> bytes,
+    or None if the budget is zero, meaning no limit.
+    """
+    if memory_budget <= 0:
+        return None
+    return max(memory_budget / (var['size'][0] * WORKING_BYTES), 1)
+
+# -- estimated working memory per data value while processing z slices
+WORKING_BYTES = 32
+
+
 def bottom_percentile(histogram, p):
     """
     Returns the smallest number i such that at least <p> percent of
@@ -262,23 +531,124 @@ def default_slice_set(var, delta, basename):
     provided that the extend of the slice in both directions would be at
     least <delta>.
     """
-    pos = list((x - 1) / 2 for x in var['size'])
+    return slice_set(var, DEFAULT_SLICES, delta, basename)
+
+
+# -- the slice set specification for default_slice_set()
+DEFAULT_SLICES = [ ('x', 'count', 1, 1, 'mean'),
+                   ('y', 'count', 1, 1, 'mean'),
+                   ('z', 'count', 1, 1, 'mean') ]
+
+def parse_slice_spec(text):
+    """
+    Turns a slice set specification given as a string into the list
+    form accepted by slice_set(). The string is a comma-separated list
+    of items, each starting with an axis 'x', 'y' or 'z', followed by
+    one of
+        *N      for N evenly spaced slices,
+        =POS    for a slice at voxel position POS within the volume,
+        @POS    for a slice at global position POS, which takes the
+                coordinate origin of the volume into account,
+    and optionally by +T to make each slice a slab of T planes. Slabs
+    hold the average of their planes, or with a further suffix :max or
+    :min, the maximum or minimum. An axis followed directly by :mean,
+    :max or :min asks for a projection along the whole axis.
+
+    For example, 'z*3+5,x@1200,y:max' asks for three evenly spaced
+    slabs perpendicular to z, each 5 planes thick, for a single x slice
+    at global position 1200 and for the maximum projection along y.
+    Raises a ValueError if the specification is invalid.
+    """
+    
+    result = []
+    for item in text.lower().split(','):
+        m = re.match(r'\s*([xyz])(?:([*=@])(\d+)(?:\+(\d+))?)?'
+                     r'(?::(mean|max|min))?\s*$', item)
+        if m is None or not (m.group(2) or m.group(5)):
+            raise ValueError("invalid slice specification: '%s'" % item)
+        (axis, op, value, thickness, method) = m.groups()
+        if op is None:
+            result.append((axis, 'all', 0, 0, method))
+            continue
+        mode = { '*': 'count', '=': 'voxel', '@': 'global' }[op]
+        if mode == 'count' and int(value) < 1:
+            raise ValueError("slice count must be positive: '%s'" % item)
+        if thickness is not None and int(thickness) < 1:
+            raise ValueError("slab thickness must be positive: '%s'" % item)
+        if method is not None and int(thickness or 1) < 2:
+            raise ValueError("only slabs can have a method: '%s'" % item)
+        result.append((axis, mode, int(value), int(thickness or 1),
+                       method or 'mean'))
+    return result
+
+def slices_per_axis(spec):
+    """
+    Returns a dictionary with the largest number of slices the list
+    <spec> can produce for each axis, keyed by upper case axis names.
+    """
+    result = dict((axis, 0) for axis in 'XYZ')
+    for (axis, mode, value, thickness, method) in spec:
+        result[axis.upper()] += value if mode == 'count' else 1
+    return result
+
+def slice_set(var, spec, delta, basename, mask_value = None):
+    """
+    Creates a list of empty slice instances, paired with associated
+    file names, as requested by the list <spec>, which holds entries
+    (axis, mode, value, thickness, method) as produced by
+    parse_slice_spec(). Positions outside the volume and slices for
+    which the extend in either direction would be less than <delta> are
+    left out, as are duplicates. Slabs need the <mask_value> of the
+    volume.
+
+    File names carry the global position, followed by the thickness
+    for slabs and the method unless that is 'mean'. For projections,
+    they carry the method only.
+    """
     size = var['size']
     dtype = var['dtype']
     origin = var['origin']
-
-    def slice_and_name(axis, pos, offset):
-        s = Slice(size, dtype, axis, pos)
-        n = "slice%c%d_%s.png" % (axis.upper(), pos + offset, basename)
-        return (s, n)
+    log = Logger()
 
     slices = []
-    if size[1] > delta and size[2] > delta:
-        slices.append(slice_and_name('x', pos[0], origin[0]))
-    if size[0] > delta and size[2] > delta:
-        slices.append(slice_and_name('y', pos[1], origin[1]))
-    if size[0] > delta and size[1] > delta:
-        slices.append(slice_and_name('z', pos[2], origin[2]))
+    names = set()
+    for (axis, mode, value, thickness, method) in spec:
+        i = 'xyz'.index(axis)
+        (u, v) = (size[j] for j in range(3) if j != i)
+        if u <= delta or v <= delta:
+            continue
+
+        if mode == 'all':
+            n = "slice%c%s_%s.png" % (axis.upper(), method, basename)
+            if n not in names:
+                names.add(n)
+                slices.append((Slice(size, dtype, axis, (size[i] - 1) / 2,
+                                     size[i], mask_value, method), n))
+            continue
+        elif mode == 'count':
+            positions = list((k + 1) * (size[i] - 1) / (value + 1)
+                             for k in range(value))
+        elif mode == 'voxel':
+            positions = [value]
+        else:
+            positions = [value - origin[i]]
+
+        for pos in positions:
+            if not 0 <= pos < size[i]:
+                log.writeln("Slice %s%s%d is outside the volume."
+                            % (axis, '=' if mode == 'voxel' else '@', value))
+                continue
+            suffix = ""
+            if thickness > 1:
+                suffix = "t%d" % thickness
+                if method != 'mean':
+                    suffix += method
+            n = "slice%c%d%s_%s.png" % (axis.upper(), pos + origin[i],
+                                        suffix, basename)
+            if n not in names:
+                names.add(n)
+                slices.append((Slice(size, dtype, axis, pos, thickness,
+                                     mask_value, method), n))
 
     return slices
 
@@ -294,6 +664,28 @@ def image_data(slice, lo, hi, mask_val, info, thumb_size = None):
     the function 'make_image' in the package of the same name.
     """
 
+    return image_set(slice, lo, hi, mask_val, info, (thumb_size,)).next()
+
+
+def image_set(slice, lo, hi, mask_val, info, sizes = (None,)):
+    """
+    A generator which works like image_data(), but produces images for
+    all the thumbnail sizes in <sizes> in turn, while converting the
+    slice data only once.
+    """
+
+    return (encode() for encode in image_encoders(slice, lo, hi, mask_val,
+                                                  info, sizes))
+
+
+def image_encoders(slice, lo, hi, mask_val, info, sizes = (None,),
+                   compress_level = None, codecs = None, tiles = None):
+    """
+    Converts a slice as for image_set(), but returns a list of functions
+    which produce the encoded images when called, as described for the
+    function of the same name in make_image.
+    """
+
     # -- determine the encoding mode
     content = slice.content
     if content.dtype == numpy.uint8:
@@ -313,18 +705,59 @@ def image_data(slice, lo, hi, mask_val, info, thumb_size = None):
     # -- generate slice-specific info
     myinfo = info.copy()
     myinfo.update({ 'slice-axis': slice.axis, 'slice-pos': slice.pos })
+    if slice.thickness > 1:
+        myinfo['slice-thickness'] = slice.thickness
+        myinfo['slice-method'] = slice.method
+
+    # -- generate and return the encoding functions
+    return make_image.image_encoders(content, lo, hi, mask_val, img_mode,
+                                     sizes, myinfo, compress_level, codecs,
+                                     tiles)
+
+
+def dummy_encoder(name, thumb_size, codec = 'png', quality = None):
+    return lambda: make_image.make_dummy(name, 256, 256, thumb_size,
+                                         codec, quality)
+
 
-    # -- generate and return the data
-    return make_image.make_image(content, lo, hi, mask_val, img_mode,
-                                 thumb_size, myinfo)
+def dummy_tile_encoder(name, tiles):
+    return lambda: make_image.tile_pyramid(make_image.dummy_image(name),
+                                           *tiles)
 
 
-def data_range(var, entries):
+# -- kinds of images a codec policy refers to, by volume data type
+IMAGE_KINDS = { numpy.uint8:   'segmented',
+                numpy.uint16:  'tomo',
+                numpy.int32:   'labels',
+                numpy.float32: 'tomo' }
+
+def choose_codecs(policy, kind, sizes):
+    """
+    Returns a (codec, quality) pair for each entry of <sizes>, as given
+    by the dictionary <policy>, which maps image kinds and the special
+    kind 'thumbnail' to such pairs. Thumbnails use the 'thumbnail' entry
+    if there is one, other images the entry for <kind>. Images without
+    a matching entry are PNG-encoded.
+    """
+    default = policy.get(kind, ('png', None))
+    return list((policy.get('thumbnail', default) if size else default)
+                for size in sizes)
+
+
+def with_codec(name, codec):
+    """
+    Replaces the extension of the image file name <name> by the one for
+    <codec>.
+    """
+    return os.path.splitext(name)[0] + make_image.CODECS[codec][0]
+
+
+def data_range(var, entries, rows = None):
     minval = maxval = None
 
     for filename in entries:
-        for tmp in z_slices(var, filename):
-            z, data = tmp[:2]
+        for tmp in z_tiles(var, filename, rows = rows):
+            data = tmp[2]
             if data is not None:
                 lo = numpy.min(data)
                 hi = numpy.max(data)
@@ -341,7 +774,15 @@ def slices(path,
            replace = False,
            dry_run = False,
            sizes = (None,),
-           info = {}):
+           info = {},
+           digest = None,
+           encoders = 0,
+           compress_level = None,
+           codecs = {},
+           tile_size = 0,
+           slice_spec = None,
+           memory_budget = 0,
+           stats = None):
     """
     A generator which extracts slice images from a Mango volume data set
     stored in a collection of NetCDF files.
@@ -349,6 +790,33 @@ def slices(path,
     The parameter <path> specifies a single NetCDF file or a directory
     containing a single volume split into several NetCDF files.
 
+    If a DataDigest instance is passed as <digest>, a checksum of the
+    volume data is computed on the fly and, once all data has been read
+    without problems, included in the image metadata. Likewise, if a
+    VolumeStats instance is passed as <stats>, it is filled from the
+    histogram of the volume and its record included in the metadata.
+
+    Images are PNG-encoded by <encoders> worker threads, or right away
+    if that is zero, and produced in order either way. The zlib level
+    used for the encoding can be set via <compress_level>. Codecs are
+    chosen by the policy <codecs> as described for choose_codecs(), and
+    existing images count regardless of the codec they were made with.
+
+    If <tile_size> is positive, a Deep Zoom tile pyramid with tiles of
+    that size is produced for each slice in addition, as a zip archive
+    named like the slice image with the prefix '__tiles__' and suffix
+    '.zip'. See tile_pyramid() in make_image for the details.
+
+    The slices made are given by the list <slice_spec> as described for
+    slice_set(), with one slice through the center along each axis as
+    the default. All of them are filled during the same pass through
+    the volume data.
+
+    If a <memory_budget> in bytes is given, z slices are read and
+    processed in pieces of as many rows as fit into it, so that apart
+    from the slices made, memory use no longer grows with the size of
+    the volume.
+
     Basic usage:
         for (data, name, action) in slices(path):
             fp = file(name, 'wb')
@@ -383,9 +851,14 @@ def slices(path,
                    numpy.float32: 1.0e30 }[var['dtype']]
 
     # -- initialize the slice set to be created
-    slices = default_slice_set(var, 10, basename)
+    slices = slice_set(var, slice_spec or DEFAULT_SLICES, 10, basename,
+                       mask_value)
+    kind = IMAGE_KINDS[var['dtype']]
+    tile_codec = choose_codecs(codecs, kind, [None])[0]
+    codecs = choose_codecs(codecs, kind, sizes)
+    stems = set(os.path.splitext(n)[0] for n in existing)
     r_or_s = 'REPLACE' if replace else 'SKIP'
-    actions = list((r_or_s if n in existing else 'ADD')
+    actions = list((r_or_s if os.path.splitext(n)[0] in stems else 'ADD')
                    for (s, n) in slices)
     slices = list(slices[i] + (actions[i],)
                   for i in range(len(slices))
@@ -396,25 +869,35 @@ def slices(path,
         return
 
     if not dry_run:
+        rows = tile_rows(var, memory_budget)
+
         # -- initialize the histogram
         if var['dtype'] == numpy.float32:
             log.writeln("Determining the data range...")
-            (minval, maxval) = data_range(var, entries)
+            (minval, maxval) = data_range(var, entries, rows)
             hist = Histogram(mask_value, minval, maxval)
         else:
             hist = Histogram(mask_value)
 
         # -- loop through files and copy data into slice arrays
+        complete = True
         for filename in entries:
             log.writeln("Processing %s..." % os.path.basename(filename))
-            for tmp in z_slices(var, filename):
-                z, data = tmp[:2]
+            for tmp in z_tiles(var, filename, digest, rows):
+                z, y, data = tmp[:3]
                 if data is None:
-                    log.writeln(tmp[2] + " at z = %d" % z, LOGGER_WARNING)
+                    log.writeln(tmp[3] + " at z = %d" % z, LOGGER_WARNING)
+                    complete = False
                 else:
                     hist.update(data)
                     for (s, n, a) in slices:
-                        s.update(data, z)
+                        s.update(data, z, y)
+
+        # -- attach the data checksum to the image metadata
+        if digest is not None and complete:
+            digest.complete = True
+            info = dict(info)
+            info['data-checksum'] = digest.value
 
         # -- analyse histogram to determine 'lo' and 'hi' values
         log.writeln("Analysing the histogram...")
@@ -426,16 +909,44 @@ def slices(path,
             lo = 0
             hi = hist.counts.size - 1
 
-    # -- encode slices as PNG images
+        # -- attach a summary of the histogram to the image metadata
+        if stats is not None and complete:
+            stats.update(hist, kind in ('labels', 'segmented'))
+            info = dict(info)
+            info['data-stats'] = stats.value
+
+    # -- encode slices as images, keeping the workers busy
     log.writeln("Making the images...")
-    for (s, n, a) in slices:
-        for sz in sizes:
+    pool = ThreadPool(encoders)
+    queue = []
+    try:
+        for (s, n, a) in slices:
+            names = list((("__%sx%s__" % sz) if sz else "")
+                         + with_codec(n, c[0])
+                         for (sz, c) in zip(sizes, codecs))
+            tiles = None
+            if tile_size > 0:
+                stem = os.path.splitext(n)[0]
+                names.append("__tiles__%s.zip" % stem)
+                tiles = (stem, tile_size) + tile_codec
             if dry_run:
-                data = make_image.make_dummy(n, 256, 256, sz)
+                tasks = list(dummy_encoder(n, sz, *c)
+                             for (sz, c) in zip(sizes, codecs))
+                if tiles is not None:
+                    tasks.append(dummy_tile_encoder(n, tiles))
             else:
-                data = image_data(s, lo, hi, mask_value, info, sz)
-            prefix = ("__%sx%s__" % sz) if sz else ""
-            yield (data, prefix + n, a)
+                tasks = image_encoders(s, lo, hi, mask_value, info, sizes,
+                                       compress_level, codecs, tiles)
+            for (name, encode) in zip(names, tasks):
+                queue.append((pool.submit(encode), name, a))
+            while queue and (len(queue) > 2 * encoders or queue[0][0].done()):
+                (future, name, action) = queue.pop(0)
+                yield (future.result(), name, action)
+        while queue:
+            (future, name, action) = queue.pop(0)
+            yield (future.result(), name, action)
+    finally:
+        pool.shutdown()
 
     # -- report success
     log.writeln("Slice image generation finished.")
@@ -0,0 +1,141 @@
+"""
+Keeps a local record of the data sets and images uploaded to Plexus, so
+that the server only needs to be asked about samples with local changes.
+"""
+
+import json, sqlite3, time
+
+from logger import Logger
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    project     TEXT,
+    sample      TEXT,
+    name        TEXT,
+    path        TEXT,
+    mtime       REAL,
+    size        INTEGER,
+    fingerprint TEXT,
+    id_ext      TEXT,
+    id_int      INTEGER,
+    images      TEXT,
+    uploaded    REAL,
+    checksum    TEXT,
+    PRIMARY KEY (project, sample, name)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    project     TEXT,
+    sample      TEXT,
+    reconciled  REAL,
+    PRIMARY KEY (project, sample)
+);
+"""
+
+
+class UploadManifest:
+    """
+    A local SQLite database recording for each data set uploaded the
+    path, modification time, size, header fingerprint and - if known -
+    data checksum of the source, the identifiers returned by Plexus and
+    the names of all images attached to it. For each sample, the time it
+    was last reconciled with the server is kept as well.
+
+    The constructor accepts the location of the database file, which is
+    created if necessary.
+    """
+
+    def __init__(self, location):
+        self.log = Logger()
+        self.location = location
+        self.db = sqlite3.connect(location)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+        # -- upgrade databases written before checksums were recorded
+        columns = list(row[1] for row in
+                       self.db.execute("PRAGMA table_info(datasets)"))
+        if 'checksum' not in columns:
+            self.db.execute("ALTER TABLE datasets ADD COLUMN checksum TEXT")
+
+    def lookup(self, project, sample, name):
+        """
+        Returns the record for the data set <name> within the given
+        project and sample as a dictionary, or None if there is none.
+        """
+        row = self.db.execute("SELECT * FROM datasets"
+                              " WHERE project = ? AND sample = ? AND name = ?",
+                              (project, sample, name)).fetchone()
+        if row is None:
+            return None
+        result = dict((k, row[k]) for k in row.keys())
+        result['images'] = json.loads(result['images'] or '[]')
+        return result
+
+    def is_current(self, project, sample, datasets):
+        """
+        Checks whether all the data sets specified by the sequence
+        <datasets> of (name, mtime, size) triples are recorded as
+        uploaded with exactly the given modification times and sizes.
+        """
+        for (name, mtime, size) in datasets:
+            rec = self.lookup(project, sample, name)
+            if (rec is None or not (rec['id_ext'] or rec['id_int'])
+                or rec['mtime'] != mtime or rec['size'] != size
+                ):
+                return False
+        return True
+
+    def nodes(self, project, sample):
+        """
+        Returns the data sets recorded for the given project and sample
+        in the same form as the node list produced by a 'stored_data'
+        request to Plexus.
+        """
+        result = {}
+        for row in self.db.execute("SELECT * FROM datasets"
+                                   " WHERE project = ? AND sample = ?",
+                                   (project, sample)):
+            result[row['name']] = {
+                'Name'    : row['name'],
+                'External': True,
+                'Date'    : time.strftime("%Y/%m/%d %H:%M:%S UTC",
+                                          time.gmtime(row['mtime'])),
+                'IdExt'   : row['id_ext'],
+                'IdInt'   : row['id_int'],
+                'Images'  : json.loads(row['images'] or '[]')
+                }
+        return result
+
+    def record(self, project, sample, name, path, mtime, size, fingerprint,
+               id_ext, id_int, images, checksum = None):
+        """
+        Stores or replaces the record for a data set.
+        """
+        self.db.execute("INSERT OR REPLACE INTO datasets"
+                        " (project, sample, name, path, mtime, size,"
+                        "  fingerprint, id_ext, id_int, images, uploaded,"
+                        "  checksum)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (project, sample, name, path, mtime, size,
+                         fingerprint, id_ext, id_int,
+                         json.dumps(sorted(images)), time.time(), checksum))
+        self.db.commit()
+
+    def last_reconciled(self, project, sample):
+        """
+        Returns the time at which the given sample was last compared
+        against the server, or None if that never happened.
+        """
+        row = self.db.execute("SELECT reconciled FROM samples"
+                              " WHERE project = ? AND sample = ?",
+                              (project, sample)).fetchone()
+        return row and row[0]
+
+    def mark_reconciled(self, project, sample):
+        self.db.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?)",
+                        (project, sample, time.time()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -3,7 +3,7 @@
 import os.path, re
 
 from file_cache import FileCache
-from nc3header import NC3Info
+from nc3header import NC3Info, FormatError
 
 
 def datafiles(path):
@@ -19,7 +19,7 @@ def datafiles(path):
 def nc3info(path):
     files = datafiles(path)
     if not files:
-        raise RuntimeError("%s: no NetCDF files in directory" % path)
+        raise FormatError("%s: no NetCDF files in directory" % path)
         
     fp = FileCache(files[0])
 
@@ -21,6 +21,13 @@ NC_VARIABLE  = 11
 NC_ATTRIBUTE = 12
 
 
+class FormatError(RuntimeError):
+    """
+    Raised when a file does not hold a valid NetCDF header.
+    """
+    pass
+
+
 class NC3Type:
     """
     Represents a NetCDF data type. Accessible fields:
@@ -145,7 +152,7 @@ def read_values(fp, type_code, number):
     size = tp.size * number
     value = fp.read(size)
     if len(value) < size:
-        raise RuntimeError("Premature end of file.")
+        raise FormatError("Premature end of file.")
     fp.read(3 - (size + 3) % 4)
     if type_code == NC_CHAR:
         return value
@@ -158,7 +165,7 @@ def read_integer(fp):
 def read_non_negative(fp):
     n = read_integer(fp)
     if n < 0:
-        raise RuntimeError("Non-negative number expected")
+        raise FormatError("Non-negative number expected")
     return n
 
 def read_string(fp):
@@ -175,7 +182,7 @@ def read_dimensions(fp):
             size = read_non_negative(fp)
             dimensions.append(NC3Dimension(name, size))
     elif tag != 0 or ndims != 0:
-        raise RuntimeError("Expected dimension array.")
+        raise FormatError("Expected dimension array.")
 
     return dimensions
 
@@ -191,7 +198,7 @@ def read_attributes(fp):
             values = read_values(fp, type, size)
             attributes.append(NC3Attribute(name, values))
     elif tag != 0 or nattr != 0:
-        raise RuntimeError("Expected attribute array.")
+        raise FormatError("Expected attribute array.")
 
     return attributes
 
@@ -211,7 +218,7 @@ def read_variables(fp, dimensions):
             start = read_non_negative(fp)
             variables.append(NC3Variable(name, dims, attr, nc_type, size, start))
     elif tag != 0 or nvars != 0:
-        raise RuntimeError("Expected variable descriptions.")
+        raise FormatError("Expected variable descriptions.")
 
     return variables
 
@@ -255,7 +262,7 @@ class NC3Info:
 
         magic = read_values(fp, NC_CHAR, 4)
         if magic != "CDF\001":
-            raise RuntimeError("Not a NetCDF version 1 file.")
+            raise FormatError("Not a NetCDF version 1 file.")
 
         self.numrecords = read_non_negative(fp)
         self.dimensions = read_dimensions(fp)
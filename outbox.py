@@ -0,0 +1,184 @@
+"""
+Keeps uploads waiting on local disk, so that payloads which are costly
+to produce survive crashes, interruptions and server outages, and can be
+sent later by a separate process, possibly on a different machine.
+"""
+
+import json, os, os.path, shelve, threading, time
+
+from logger import Logger
+
+
+class Outbox:
+    """
+    A directory of pending uploads. The constructor accepts the path of
+    the directory, which is created if necessary.
+
+    Each upload consists of a payload file '<id>.dat' and a manifest
+    '<id>.json' describing it, where <id> starts with the time the
+    upload was added, so that sorting by id gives the order in which
+    uploads were queued. Both files are written under temporary names
+    first and then renamed, the manifest last, so that an interrupted
+    write never leaves a partial upload behind. Each manifest holds a
+    unique 'key', and adding an upload with the key of a pending one
+    replaces the latter.
+
+    The identifiers the server assigns to data sets sent from the
+    outbox are kept in the shelve file 'nodes' within the directory, so
+    that images queued before their data set was uploaded can still be
+    attached to it later. Safe to use from several threads.
+    """
+
+    def __init__(self, location):
+        self.log = Logger()
+        self.location = location
+        if not os.path.isdir(location):
+            os.makedirs(location)
+        self.nodes = shelve.open(os.path.join(location, 'nodes'))
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+        # -- index pending uploads by key, dropping leftovers of crashes
+        self._pending = {}
+        for f in os.listdir(location):
+            if f.endswith('.tmp'):
+                os.remove(os.path.join(location, f))
+        for (id, meta) in self.entries():
+            self._pending[meta['key']] = (id, meta)
+
+    def path(self, id, suffix):
+        return os.path.join(self.location, id + suffix)
+
+    def entries(self):
+        """
+        Returns the pending uploads as a list of (id, manifest) pairs in
+        the order they were queued.
+        """
+        ids = sorted(f[:-5] for f in os.listdir(self.location)
+                     if f.endswith('.json'))
+        result = []
+        for id in ids:
+            try:
+                fp = open(self.path(id, '.json'))
+                try:
+                    result.append((id, json.load(fp)))
+                finally:
+                    fp.close()
+            except (IOError, ValueError), ex:
+                self.log.trace("Ignoring outbox entry %s: %s" % (id, ex))
+        return result
+
+    def pending(self, key):
+        """
+        Returns the manifest for the pending upload with the given key,
+        or None if there is none.
+        """
+        entry = self._pending.get(key)
+        return entry and entry[1]
+
+    def pending_images(self, dataset):
+        """
+        Returns the names of all pending images for the data set with
+        the given key.
+        """
+        return list(meta['name'] for (id, meta) in self._pending.values()
+                    if meta.get('dataset') == dataset
+                    if meta['kind'] == 'image')
+
+    def put(self, meta, data):
+        """
+        Adds an upload with the manifest <meta>, a dictionary containing
+        at least a 'key', and the payload <data>, which can be a string
+        or an iterable of strings. Returns the id of the new entry.
+        """
+        self._lock.acquire()
+        try:
+            self._sequence += 1
+            id = "%016d-%05d-%06d" % (time.time() * 1e6, os.getpid(),
+                                      self._sequence)
+        finally:
+            self._lock.release()
+
+        self.write(self.path(id, '.dat'), data)
+        self.write(self.path(id, '.json'), json.dumps(meta))
+
+        self._lock.acquire()
+        try:
+            old = self._pending.get(meta['key'])
+            self._pending[meta['key']] = (id, meta)
+        finally:
+            self._lock.release()
+        if old is not None:
+            self.remove(old[0])
+        return id
+
+    def write(self, path, data):
+        """
+        Writes <data> to the file at <path> atomically.
+        """
+        if isinstance(data, str):
+            data = (data,)
+        fp = open(path + '.tmp', 'wb')
+        try:
+            for chunk in data:
+                fp.write(chunk)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(path + '.tmp', path)
+
+    def payload(self, id):
+        """
+        Returns the payload for the upload with the given id as an open
+        file.
+        """
+        return open(self.path(id, '.dat'), 'rb')
+
+    def remove(self, id):
+        """
+        Removes the upload with the given id, manifest first.
+        """
+        self._lock.acquire()
+        try:
+            for (key, entry) in self._pending.items():
+                if entry[0] == id:
+                    del self._pending[key]
+        finally:
+            self._lock.release()
+        for suffix in ('.json', '.dat'):
+            try:
+                os.remove(self.path(id, suffix))
+            except OSError:
+                pass
+
+    def set_node(self, key, id_ext, id_int):
+        """
+        Records the identifiers assigned to the data set with the given
+        key.
+        """
+        self._lock.acquire()
+        try:
+            self.nodes[as_str(key)] = { 'IdExt': id_ext, 'IdInt': id_int }
+            self.nodes.sync()
+        finally:
+            self._lock.release()
+
+    def node(self, key):
+        """
+        Returns the identifiers recorded for the data set with the given
+        key as a dictionary, or None if there are none.
+        """
+        return self.nodes.get(as_str(key))
+
+    def close(self):
+        self.nodes.close()
+
+
+def as_str(key):
+    """
+    Converts <key> into a byte string, as required by shelve.
+    """
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
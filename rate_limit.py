@@ -0,0 +1,128 @@
+"""
+Client-side throttling for requests to a web server, so that a scan
+running at full speed does not overload it.
+
+(Requires Python 2.6 or higher.)
+"""
+
+import threading, time
+
+
+class TokenBucket:
+    """
+    Limits the average rate at which some quantity is consumed. The
+    constructor accepts the <rate> in units per second, where zero means
+    no limit, and optionally the <capacity> of the bucket, which bounds
+    the size of bursts and defaults to one second's worth.
+
+    Requests for more units than currently available are granted once
+    the bucket has refilled sufficiently, so that single large requests
+    are delayed rather than refused. Safe to use from several threads.
+    """
+
+    def __init__(self, rate, capacity = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, amount = 1):
+        """
+        Consumes <amount> units, waiting as long as necessary.
+        """
+        if self.rate <= 0:
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate
+        finally:
+            self._lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Throttles one class of requests. The constructor accepts limits on
+    the number of <requests> and <bytes> sent per second, where zero
+    means no limit, and the largest number of requests <max_concurrency>
+    that may be in flight at once.
+
+    The number of concurrent requests actually allowed is adjusted
+    according to the AIMD scheme also used for TCP congestion control:
+    it grows by one for each window of successful requests, and is
+    halved when the server signals overload or latencies rise to
+    <latency_factor> times the best smoothed latency seen so far.
+    Decreases happen at most once per smoothed latency period, so that
+    a single burst of slow responses counts only once. Since request
+    sizes vary, latencies below <latency_floor> seconds are never taken
+    as a sign of overload.
+    """
+
+    def __init__(self, requests = 0, bytes = 0, max_concurrency = 16,
+                 latency_factor = 4.0, latency_floor = 1.0):
+        self.requests = TokenBucket(requests)
+        self.bytes = TokenBucket(bytes)
+        self.max_concurrency = max_concurrency
+        self.latency_factor = latency_factor
+        self.latency_floor = latency_floor
+        self.window = float(max_concurrency)
+        self.in_flight = 0
+        self.latency = None       # -- smoothed latency
+        self.best_latency = None  # -- lowest smoothed latency seen
+        self.last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size = 0):
+        """
+        Waits until a request of <size> bytes may be sent.
+        """
+        self._cond.acquire()
+        try:
+            while self.in_flight >= max(int(self.window), 1):
+                self._cond.wait(1.0)
+            self.in_flight += 1
+        finally:
+            self._cond.release()
+        self.requests.take(1)
+        self.bytes.take(size)
+
+    def release(self, elapsed, overloaded = False):
+        """
+        Reports that a request has finished after <elapsed> seconds. If
+        <overloaded> is true, the server did not handle it successfully
+        because of overload or a timeout.
+        """
+        self._cond.acquire()
+        try:
+            self.in_flight -= 1
+            if not overloaded:
+                if self.latency is None:
+                    self.latency = elapsed
+                else:
+                    self.latency = 0.8 * self.latency + 0.2 * elapsed
+                self.best_latency = min(self.best_latency or self.latency,
+                                        self.latency)
+                overloaded = (self.latency > self.latency_floor and
+                              self.latency > self.latency_factor
+                              * self.best_latency)
+
+            now = time.time()
+            if not overloaded:
+                self.window = min(self.window + 1.0 / self.window,
+                                  float(self.max_concurrency))
+            elif now - self.last_decrease > (self.latency or elapsed):
+                self.window = max(self.window / 2, 1.0)
+                self.last_decrease = now
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def concurrency(self):
+        return max(int(self.window), 1)
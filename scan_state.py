@@ -0,0 +1,86 @@
+"""
+Keeps a persistent record of the directories visited during a scan, so
+that subtrees which have not changed since they were last processed
+successfully can be skipped on the next run.
+"""
+
+import os, os.path, shelve
+
+from logger import Logger
+
+
+class ScanState:
+    """
+    A local store of directory states. The constructor accepts the
+    path of the shelve file to keep the records in, which is created
+    if necessary.
+
+    For each directory processed, the modification time and number of
+    entries are stored, together with the list of subdirectories,
+    whether processing completed without errors and how many files
+    were uploaded successfully from within that directory.
+
+    A directory is considered unchanged if it was processed completely
+    and neither its own modification time and entry count nor those of
+    any of its recorded subdirectories differ from the stored values.
+    Note that rewriting a file in place does not change the modification
+    time of the directory it sits in.
+    """
+
+    def __init__(self, location):
+        self.log = Logger()
+        self.location = location
+        self.db = shelve.open(location)
+
+    def snapshot(self, path):
+        """
+        Returns the current modification time and number of entries for
+        the directory at <path> as a pair, or None if it cannot be read.
+        """
+        try:
+            return (os.stat(path).st_mtime, len(os.listdir(path)))
+        except OSError:
+            return None
+
+    def unchanged(self, path):
+        """
+        Checks whether the directory at <path> and all its recorded
+        subdirectories are unchanged since the last complete scan.
+        """
+        rec = self.db.get(path)
+        if rec is None or not rec['complete']:
+            return False
+        if self.snapshot(path) != (rec['mtime'], rec['entries']):
+            self.log.trace("Directory changed: %s" % path)
+            return False
+        for sub in rec['subdirs']:
+            if not self.unchanged(sub):
+                return False
+        return True
+
+    def record(self, path, complete, uploads = 0, subdirs = (), leaves = ()):
+        """
+        Stores the current state of the directory at <path>. The
+        directories in <subdirs> are assumed to have been recorded
+        separately, whereas those in <leaves> are recorded here as
+        subtrees without further subdirectories.
+        """
+        state = self.snapshot(path)
+        if state is None:
+            return
+        for leaf in leaves:
+            leaf_state = self.snapshot(leaf)
+            if leaf_state is not None:
+                self.db[leaf] = { 'mtime'   : leaf_state[0],
+                                  'entries' : leaf_state[1],
+                                  'subdirs' : [],
+                                  'complete': complete,
+                                  'uploads' : 0 }
+        self.db[path] = { 'mtime'   : state[0],
+                          'entries' : state[1],
+                          'subdirs' : list(subdirs) + list(leaves),
+                          'complete': complete,
+                          'uploads' : uploads }
+
+    def close(self):
+        self.db.close()
@@ -14,12 +14,14 @@ either from the commandline or via the pattern
 
 where 'attachments' is a sequence of (content, name) pairs.
 
-(Requires Python 2.4 or higher.)
+(Requires Python 2.6 or higher.)
 """
 
-import httplib, mimetypes, os, os.path, re, time
+import httplib, mimetypes, os, os.path, random, re, socket, tempfile
+import sys, threading, time, zlib
 
 from logger import Logger, LOGGER_ERROR
+from rate_limit import RateLimiter
 
 def encode_formdata(fields, files):
     """
@@ -56,6 +58,268 @@ def encode_formdata(fields, files):
     return content_type, body
 
 
+def gzipped(data, level = 6):
+    """
+    A generator producing the gzip-compressed form of <data>, which
+    may be a string or an iterable of strings, in pieces.
+    """
+    if isinstance(data, str):
+        data = (data,)
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in data:
+        packed = z.compress(chunk)
+        if packed:
+            yield packed
+    yield z.flush()
+
+
+class MultipartBody:
+    """
+    A multipart/form-data message that is written to a connection in
+    chunks instead of being composed in memory. The constructor takes
+    the same <fields> and <files> arguments as encode_formdata(). Field
+    values are converted via str(). Attached file data may be given as
+    a string, an open file, which is read from its current position, or
+    any other iterable producing strings, such as a generator.
+
+    The total length is known up front via the attribute 'length'. So
+    that it can be determined and the message be sent again on retries,
+    data from iterables other than files is first spooled into an
+    anonymous temporary file. Such files are removed by close().
+    """
+    
+    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    
+    def __init__(self, fields, files, chunk_size = 64 * 1024):
+        self.chunk_size = chunk_size
+        self.content_type = ('multipart/form-data; boundary=%s'
+                             % self.BOUNDARY)
+        self._parts = []    # strings and (file, start, size) triples
+        self._spooled = []  # temporary files to close when done
+        
+        for (key, value) in fields:
+            self._parts.append('--%s\r\n'
+                               'Content-Disposition: form-data; name="%s"'
+                               '\r\n\r\n%s\r\n'
+                               % (self.BOUNDARY, key, str(value)))
+            
+        for (key, filename, value) in files:
+            self._parts.append(str('--%s\r\n'
+                                   'Content-Disposition: form-data; name="%s";'
+                                   ' filename="%s"\r\n'
+                                   'Content-Type: %s\r\n\r\n'
+                                   % (self.BOUNDARY, key, filename,
+                                      mimetypes.guess_type(filename)[0]
+                                      or 'application/octet-stream')))
+            self._parts.append(self.payload(value))
+            self._parts.append('\r\n')
+            
+        self._parts.append('--%s--\r\n' % self.BOUNDARY)
+
+        self.length = sum((len(p) if isinstance(p, str) else p[2])
+                          for p in self._parts)
+
+    def payload(self, value):
+        """
+        Converts attachment data into either a string or a triple of the
+        form (file, start, size).
+        """
+        if isinstance(value, str):
+            return value
+        elif hasattr(value, 'read') and hasattr(value, 'seek'):
+            start = value.tell()
+            value.seek(0, os.SEEK_END)
+            size = value.tell() - start
+            value.seek(start)
+            return (value, start, size)
+        elif hasattr(value, '__iter__'):
+            fp = tempfile.TemporaryFile()
+            self._spooled.append(fp)
+            for chunk in value:
+                fp.write(chunk)
+            size = fp.tell()
+            fp.seek(0)
+            return (fp, 0, size)
+        else:
+            return str(value)
+
+    def pieces(self):
+        """
+        A generator producing the message body in pieces no longer than
+        'chunk_size'.
+        """
+        n = self.chunk_size
+        for part in self._parts:
+            if isinstance(part, str):
+                for i in xrange(0, len(part), n):
+                    yield part[i : i + n]
+            else:
+                (fp, start, size) = part
+                fp.seek(start)
+                while size > 0:
+                    data = fp.read(min(n, size))
+                    if not data:
+                        raise IOError("attachment shrank while sending")
+                    size -= len(data)
+                    yield data
+
+    def write_to(self, h):
+        """
+        Sends the message body over the connection <h>, combining small
+        pieces into chunks of about 'chunk_size' bytes.
+        """
+        buffer = []
+        filled = 0
+        for piece in self.pieces():
+            buffer.append(piece)
+            filled += len(piece)
+            if filled >= self.chunk_size:
+                h.send(''.join(buffer))
+                buffer = []
+                filled = 0
+        if buffer:
+            h.send(''.join(buffer))
+
+    def close(self):
+        for fp in self._spooled:
+            fp.close()
+        self._spooled = []
+
+
+class ConnectionPool:
+    """
+    Keeps persistent HTTP or HTTPS connections to a single server, so
+    that successive requests can reuse them instead of paying for a new
+    TCP and TLS handshake each time. The constructor accepts the base
+    URL <server> and optionally the maximal number <size> of idle
+    connections to keep and a socket <timeout> in seconds.
+
+    Connections are handed out by acquire() and must be returned via
+    release() once the response has been read completely, or via
+    discard() if they are broken. The pool is safe to share between
+    threads.
+    """
+
+    def __init__(self, server, size = 4, timeout = None):
+        if server.startswith("https://"):
+            self.scheme = "https"
+            self.host = re.sub('^https:\/\/', '', server)
+        else:
+            self.scheme = "http"
+            self.host = re.sub('^http:\/\/', '', server)
+        self.size    = size
+        self.timeout = timeout
+        self.created = 0
+        self.log     = Logger()
+        self._idle   = []
+        self._lock   = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns an idle connection if there is one, or else a new one.
+        Connections that have served requests before are marked by a
+        positive value in their 'use_count' attribute.
+        """
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        finally:
+            self._lock.release()
+
+        self.log.writeln("Connecting to %s using %s" % (self.host, self.scheme))
+        if self.scheme == "https":
+            h = httplib.HTTPSConnection(self.host, timeout = self.timeout)
+        else:
+            h = httplib.HTTPConnection(self.host, timeout = self.timeout)
+        h.use_count = 0
+        return h
+
+    def release(self, h):
+        h.use_count += 1
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(h)
+                return
+        finally:
+            self._lock.release()
+        h.close()
+
+    def discard(self, h):
+        h.close()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for h in idle:
+            h.close()
+
+
+class ServerError(Exception):
+    """
+    Raised for responses indicating that the server or a gateway in
+    front of it is temporarily unable to handle requests.
+    """
+    pass
+
+
+# -- exceptions indicating that a request may succeed when repeated
+RETRYABLE = (httplib.HTTPException, socket.error, ServerError)
+
+
+class CircuitBreaker:
+    """
+    Keeps track of consecutive request failures. After <threshold>
+    failures in a row, the circuit is 'open' for <cooldown> seconds,
+    during which no requests should be sent. After that, requests are
+    let through again, but the next failure reopens the circuit right
+    away. Any successful request closes it. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, threshold = 5, cooldown = 60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.log = Logger()
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """
+        Returns the number of seconds the circuit stays open, or 0.
+        """
+        return max(self.open_until - time.time(), 0)
+
+    def success(self):
+        self._lock.acquire()
+        try:
+            self.failures = 0
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.failures >= self.threshold > 0:
+                if self.remaining() == 0:
+                    self.log.writeln("Server seems to be down - pausing"
+                                     " requests for %d seconds"
+                                     % self.cooldown, LOGGER_ERROR)
+                self.open_until = time.time() + self.cooldown
+        finally:
+            self._lock.release()
+
+
 class Connection:
     """
     Holds connection and authentication data for the Plexus server and
@@ -91,11 +355,48 @@ class Connection:
             
         # -- set default retry parameters
         self.retry_limit = 10  # number of upload attempts
-        self.retry_wait  = 300 # waiting period between upload attempts (sec)
+        self.retry_base  = 5   # waiting period before the first retry (sec)
+        self.retry_wait  = 300 # maximal waiting period between attempts (sec)
+        self.breaker     = CircuitBreaker()
+
+        # -- separate throttles for information queries and uploads
+        self.limits = { 'info'  : RateLimiter(),
+                        'upload': RateLimiter() }
+        
+        # -- persistent connections and request statistics
+        self.pool = ConnectionPool(server)
+        self.request_count = 0
+        self.request_time  = 0.0
+        self._stats_lock   = threading.Lock()
         
         self.log = Logger()
 
-    def post_form(self, selector, fields, files):
+    def retry_delay(self, attempts, exc_info):
+        """
+        Returns the number of seconds to wait before retrying a request
+        that failed with the exception described by <exc_info> after
+        <attempts> attempts, or None if it should not be retried.
+
+        Waiting periods grow exponentially from 'retry_base' up to at
+        most 'retry_wait', with random jitter so that retries from
+        several threads do not come in bursts. While the circuit breaker
+        is open, requests are held back until it closes. Only connection
+        problems and server errors are retried.
+        """
+        
+        ex = exc_info[1]
+        if not isinstance(ex, RETRYABLE):
+            return None
+        if attempts >= self.retry_limit:
+            self.log.writeln("too many retries - giving up", LOGGER_ERROR)
+            return None
+        delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_wait)
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        delay = max(delay, self.breaker.remaining())
+        self.log.writeln("(will retry in %.1f seconds)" % delay)
+        return delay
+
+    def post_form(self, selector, fields, files, retry = True):
         """
         Composes an multipart/form-data message, posts it to the URL on
         the server given by the relative path <selector> and returns a
@@ -104,47 +405,158 @@ class Connection:
         
         Normal fields are specified as a sequence <fields> of
         (name, value) pairs. Attached file data is specified as a
-        sequence <files> of (name, filename, value) elements.
+        sequence <files> of (name, filename, value) elements, where each
+        value can be a string, an open file or an iterable of strings as
+        described for MultipartBody. If <retry> is false, exceptions are
+        passed on right away, so that the caller can schedule retries.
         """
         
-        content_type, body = encode_formdata(fields, files)
+        body = MultipartBody(fields, files)
         headers = {
             'User-Agent': 'python',
-            'Content-Type': content_type,
+            'Content-Type': body.content_type,
+            'Content-Length': str(body.length),
             'Accept': 'application/json'
             }
 
+        kind = files and 'upload' or 'info'
+        try:
+            if retry:
+                return self.post_body(selector, body, headers, kind)
+            else:
+                return self.send_request(selector, body, headers, kind)
+        finally:
+            body.close()
+
+    def post_body(self, selector, body, headers, kind = 'info'):
+        """
+        Posts the MultipartBody <body> with the given <headers>, retrying
+        as determined by 'retry_delay()'.
+
+        Since the caller waits for the result, requests are not held back
+        while the circuit breaker is open, but fail right away, so that
+        the scan can move on rather than wait for the server to recover.
+        """
+        
         count = 0
         while True:
             try:
-                if self.server.startswith("https://"):
-                    host = re.sub('^https:\/\/', '', self.server)
-                    self.log.writeln("Connecting to %s using https" % host)
-                    h = httplib.HTTPSConnection(host)
-                else:
-                    host = re.sub('^http:\/\/', '', self.server)
-                    self.log.writeln("Connecting to %s using http" % host)
-                    h = httplib.HTTPConnection(host)
-                        
-                h.request('POST', selector, body, headers)
-                res = h.getresponse()
-                return res.status, res.reason, res.read()
-            except KeyboardInterrupt, ex:
-                raise ex
-            except Exception, ex:
-                self.log.writeln("> %s: %s <" % (ex.__class__.__name__, ex),
-                                 LOGGER_ERROR)
+                return self.send_request(selector, body, headers, kind)
+            except RETRYABLE, ex:
                 count += 1
-                if count < self.retry_limit:
-                    self.log.writeln("(will retry in %d seconds)"
-                                     % self.retry_wait)
-                    time.sleep(self.retry_wait)
-                    self.log.writeln("retrying...")
-                else:
-                    self.log.writeln("too many retries - giving up",
-                                     LOGGER_ERROR)
-                    raise ex
-                
+                if self.breaker.remaining() > 0:
+                    raise
+                delay = self.retry_delay(count, sys.exc_info())
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                self.log.writeln("retrying...")
+
+    def send_request(self, selector, body, headers, kind = 'info'):
+        """
+        Posts a request over a pooled connection and returns a tuple
+        consisting of the HTTP status, reason and response text. If a
+        reused connection turns out to have been closed by the server,
+        the request is repeated once on a fresh one.
+
+        Connection problems and responses indicating that the server is
+        temporarily unavailable raise an exception and count as failures
+        for the circuit breaker. While it is open, no request is sent.
+
+        Requests are throttled by the rate limiter for the given <kind>,
+        which is either 'info' or 'upload'.
+        """
+        
+        if self.breaker.remaining() > 0:
+            raise ServerError("server unavailable - circuit breaker open")
+
+        limiter = self.limits[kind]
+        limiter.acquire(body.length)
+        start = time.time()
+        try:
+            result = self.send_once(selector, body, headers)
+        except (httplib.HTTPException, socket.error), ex:
+            limiter.release(time.time() - start, True)
+            self.report_failure(selector, ex)
+            raise
+        except KeyboardInterrupt:
+            limiter.release(time.time() - start)
+            raise
+        except:
+            # -- the request did not complete, so it must not count as fast
+            limiter.release(time.time() - start, True)
+            raise
+        elapsed = time.time() - start
+        limiter.release(elapsed, result[0] in (502, 503, 504))
+
+        if result[0] in (502, 503, 504):
+            ex = ServerError("%d - %s" % result[:2])
+            self.report_failure(selector, ex)
+            raise ex
+        self.breaker.success()
+
+        self._stats_lock.acquire()
+        try:
+            self.request_count += 1
+            self.request_time  += elapsed
+        finally:
+            self._stats_lock.release()
+        self.log.writeln("POST %s: %d in %.3f sec" % (selector, result[0],
+                                                       elapsed))
+        return result
+
+    def send_once(self, selector, body, headers):
+        """
+        Does the actual work for 'send_request()'.
+        """
+        
+        while True:
+            h = self.pool.acquire()
+            try:
+                if h.sock is None:
+                    # -- headers and body are sent separately, so no delays
+                    h.connect()
+                    h.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                      1)
+                h.putrequest('POST', selector)
+                for (key, value) in headers.items():
+                    h.putheader(key, value)
+                h.endheaders()
+                body.write_to(h)
+                res = h.getresponse()
+                result = (res.status, res.reason, res.read())
+            except (httplib.HTTPException, socket.error), ex:
+                self.pool.discard(h)
+                if h.use_count > 0 and not isinstance(ex, socket.timeout):
+                    self.log.trace("Stale connection (%s) - reconnecting"
+                                   % ex.__class__.__name__)
+                    continue
+                raise
+            except:
+                self.pool.discard(h)
+                raise
+            self.pool.release(h)
+            return result
+
+    def report_failure(self, selector, ex):
+        self.log.writeln("> POST %s: %s: %s <" % (selector,
+                                                  ex.__class__.__name__, ex),
+                         LOGGER_ERROR)
+        self.breaker.failure()
+
+    def request_statistics(self):
+        """
+        Returns a short text summarizing the requests made so far.
+        """
+        
+        average = self.request_time / max(self.request_count, 1)
+        return ("%d requests over %d connections, average latency %.3f sec,"
+                " final upload concurrency %d"
+                % (self.request_count, self.pool.created, average,
+                   self.limits['upload'].concurrency()))
+
+    def close(self):
+        self.pool.close()
     
     def post_info_request(self, project, sample):
         """
@@ -164,8 +576,31 @@ class Connection:
         return self.post_form("/samples/stored_data", fields, [])
 
 
+    def post_bulk_info_request(self, project, samples):
+        """
+        Request information on data stored for all of the given
+        <samples> within a project in one go.
+
+        Returns a tuple consisting of the HTTP status, reason and
+        response text as received from the server. The response is
+        expected to contain a dictionary 'Samples' mapping each sample
+        name to the same data a 'stored_data' request would produce.
+        Servers without support for this will reject the request with a
+        404 or similar status.
+        """
+        
+        # -- provide the mandatory fields for this request
+        fields = [("user[name]", self.user),
+                  ("user[password]", self.password),
+                  ("project", project)]
+        fields.extend(("samples[]", sample) for sample in samples)
+        
+        # -- post the request to the "/projects/stored_data" service
+        return self.post_form("/projects/stored_data", fields, [])
+
+
     def post_import(self, project, sample, mtime, data, name, description,
-                    replace = False):
+                    replace = False, compressed = False):
         """
         Uploads a file '<name>' with content <data> and explanatory
         text '<description>' to the sample '<sample>' in the project
@@ -173,6 +608,11 @@ class Connection:
         <mtime>. If <replace> is true, Plexus is asked to replace
         existing data where necessary.
 
+        If <compressed> is true, <data> must be gzip-compressed. It is
+        then sent as '<name>.gz' together with a field 'encoding' with
+        the value 'gzip'. Servers that cannot handle this will reject
+        the request with a 415 or similar status.
+
         Returns a tuple consisting of the HTTP status, reason and
         response text as received from the server.
         """
@@ -186,6 +626,9 @@ class Connection:
                   ("manager", self.manager),
                   ("replace", str(replace)),
                   ("description", description))
+        if compressed:
+            fields += (("encoding", "gzip"),)
+            name += ".gz"
         
         # -- convert attachment data into the form expected by Plexus
         uploads = (("data", name, data),)
@@ -195,12 +638,13 @@ class Connection:
 
 
     def post_image(self, project, sample, attach_to, mtime, data, name,
-                   caption, replace = False):
+                   caption, replace = False, retry = True):
         """
         Uploads an image to Plexus. The parameters are as in
         post_import, except that <caption> takes on the role of
         <description> and the image is associated to the dataset with
-        global identifier '<attach_to>'.
+        global identifier '<attach_to>'. If <retry> is false, failed
+        requests are not retried, as described for post_form().
         """
 
         # -- provide the mandatory fields for this request
@@ -219,4 +663,40 @@ class Connection:
         uploads = (("picture[uploaded_data]", name, data),)
         
         # -- post the request to the "/update" service and return the results
-        return self.post_form("/pictures", fields, uploads)
+        return self.post_form("/pictures", fields, uploads, retry)
+
+
+    def post_images(self, project, sample, attach_to, mtime, images,
+                    replace = False, retry = True):
+        """
+        Uploads several images for the same dataset in a single request.
+        The sequence <images> holds a (data, name, caption) triple for
+        each image. Other parameters are as for post_image().
+
+        Each image is sent as a separate part named 'pictures[<i>][data]'
+        with its caption in the field 'pictures[<i>][caption]', where
+        <i> counts from zero. The server is expected to respond with an
+        overall 'Status' and a list 'Pictures' holding the result for
+        each image, including its 'Name'. Servers without support for
+        batches will reject the request with a 404 or similar status.
+        """
+
+        # -- provide the mandatory fields for this request
+        fields = [("user[name]", self.user),
+                  ("user[password]", self.password),
+                  ("data_spec[project]", project),
+                  ("data_spec[sample]", sample),
+                  ("data_spec[identifier]", attach_to['IdExt']),
+                  ("data_id", attach_to['IdInt']),
+                  ("time", mtime),
+                  ("manager", self.manager),
+                  ("replace", str(replace))]
+
+        # -- add metadata and attachment data for each image
+        uploads = []
+        for (i, (data, name, caption)) in enumerate(images):
+            fields.append(("pictures[%d][caption]" % i, caption))
+            uploads.append(("pictures[%d][data]" % i, name, data))
+        
+        # -- post the request to the "/pictures/batch" service
+        return self.post_form("/pictures/batch", fields, uploads, retry)
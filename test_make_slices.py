@@ -0,0 +1,59 @@
+"""
+Tests for the histogram and statistics code in make_slices.
+
+Run with: python -m unittest test_make_slices
+"""
+
+import unittest
+
+import numpy
+
+from make_slices import Histogram, VolumeStats
+
+
+def stats_for(data, mask_value, dtype):
+    hist = Histogram(mask_value)
+    hist.update(numpy.array(data, dtype))
+    stats = VolumeStats(percentiles = (50,))
+    stats.update(hist, phases = True)
+    return stats.record
+
+
+class VolumeStatsTest(unittest.TestCase):
+
+    def check_masked(self, mask_value, dtype):
+        record = stats_for([1, 1, 2, 2, 3] + [mask_value] * 5,
+                           mask_value, dtype)
+        self.assertEqual(record['voxels'], 10)
+        self.assertEqual(record['masked'], 0.5)
+        self.assertEqual(record['min'], 1)
+        self.assertEqual(record['max'], 3)
+        self.assertEqual(record['percentiles'], { '50': 2 })
+        self.assertEqual(record['phase_count'], 3)
+        self.assertEqual(record['phases'], { '1': 2, '2': 2, '3': 1 })
+
+    def test_uint8_mask(self):
+        self.check_masked(0xff, numpy.uint8)
+
+    def test_uint16_mask(self):
+        self.check_masked(0xffff, numpy.uint16)
+
+    def test_int32_mask(self):
+        self.check_masked(0x7fffffff, numpy.int32)
+
+    def test_zero_counts_as_phase(self):
+        record = stats_for([0, 0, 1, 0xff], 0xff, numpy.uint8)
+        self.assertEqual(record['voxels'], 4)
+        self.assertEqual(record['min'], 0)
+        self.assertEqual(record['phases'], { '0': 2, '1': 1 })
+
+    def test_all_masked(self):
+        record = stats_for([0xffff] * 4, 0xffff, numpy.uint16)
+        self.assertEqual(record['voxels'], 4)
+        self.assertEqual(record['masked'], 1.0)
+        self.assertFalse('min' in record)
+        self.assertEqual(record['phase_count'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+"""
+Tests for the change detection, slice metadata and failure handling in
+update_plexus. Writing the NetCDF test data requires scipy.
+
+Run with: python -m unittest test_update_plexus
+"""
+
+import os, shutil, tempfile, time, unittest
+from StringIO import StringIO
+
+import numpy
+from PIL import Image
+
+try:
+    from scipy.io import netcdf
+except ImportError:
+    netcdf = None
+
+import update_plexus
+from failure_memo import FailureMemo
+from file_cache import FileCache
+from history import History
+from make_slices import volume_checksum, DataDigest, VolumeStats
+from manifest import UploadManifest
+from update_plexus import Updater, UnusableData, prefetched
+
+
+def write_volume(path, data):
+    f = netcdf.netcdf_file(path, 'w', version = 1)
+    (z, y, x) = data.shape
+    f.createDimension('tomo_zdim', z)
+    f.createDimension('tomo_ydim', y)
+    f.createDimension('tomo_xdim', x)
+    v = f.createVariable('tomo', 'h', ('tomo_zdim', 'tomo_ydim', 'tomo_xdim'))
+    v[:] = data
+    setattr(f, 'history_20130101_120000_tomo_a',
+            'COMMAND prog in_nc tomo_a.nc\nUSER me\n')
+    f.close()
+
+
+@unittest.skipIf(netcdf is None, "scipy is not available")
+class ContentChangedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tomo_a.nc')
+        self.data = numpy.arange(4 * 5 * 6, dtype = 'int16').reshape(4, 5, 6)
+        write_volume(self.path, self.data)
+
+        self.updater = Updater('user', 'password', checksum = 'md5')
+        self.node = {
+            'Date'       : time.strftime("%Y/%m/%d %H:%M:%S UTC",
+                                         time.gmtime(time.time() - 3600)),
+            'Fingerprint': self.updater.read_header(self.path).fingerprint,
+            'Checksum'   : volume_checksum(self.path, 'md5'),
+            'IdExt'      : 'ext',
+            'IdInt'      : 1 }
+        self.volume_checksum = update_plexus.volume_checksum
+
+    def tearDown(self):
+        update_plexus.volume_checksum = self.volume_checksum
+        if self.updater.manifest is not None:
+            self.updater.manifest.close()
+        shutil.rmtree(self.dir)
+
+    def changed(self):
+        return self.updater.content_changed('proj', 'samp', self.path,
+                                            self.node)[0]
+
+    def test_same_data(self):
+        write_volume(self.path, self.data)
+        self.assertFalse(self.changed())
+
+    def test_same_header_different_data(self):
+        write_volume(self.path, self.data + 1)
+        self.assertEqual(self.updater.read_header(self.path).fingerprint,
+                         self.node['Fingerprint'])
+        self.assertTrue(self.changed())
+
+    def test_without_checksums(self):
+        self.updater.checksum = None
+        write_volume(self.path, self.data + 1)
+        self.assertFalse(self.changed())
+
+    def test_verified_only_once(self):
+        self.updater.manifest = UploadManifest(os.path.join(self.dir, 'db'))
+        calls = []
+        def counting(*args):
+            calls.append(args)
+            return self.volume_checksum(*args)
+        update_plexus.volume_checksum = counting
+
+        write_volume(self.path, self.data)
+        self.assertFalse(self.changed())
+        self.assertEqual(len(calls), 1)
+        self.updater.remember_dataset('proj', 'samp', self.path, self.node,
+                                      self.node['Fingerprint'])
+        self.assertFalse(self.changed())
+        self.assertEqual(len(calls), 1)
+
+
+@unittest.skipIf(netcdf is None, "scipy is not available")
+class SliceMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tomo_a.nc')
+        data = numpy.arange(20 ** 3, dtype = 'int16').reshape(20, 20, 20)
+        write_volume(self.path, data % 300)
+        self.updater = Updater('user', 'password', checksum = 'md5')
+        self.history = History(self.updater.read_header(self.path),
+                               self.path,
+                               time.gmtime(os.path.getmtime(self.path)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def image_info(self, images):
+        return list(Image.open(StringIO(data)).info
+                    for (data, name, action) in images)
+
+    def test_checksum(self):
+        digest = DataDigest('md5')
+        images = prefetched(self.updater.slice_images(
+                self.path, [], self.history, digest))
+        self.history.add_to_data_file('checksum', digest.value)
+        infos = self.image_info(images)
+        self.assertEqual(len(infos), 9)
+        for info in infos:
+            self.assertEqual(info['data-checksum'], digest.value)
+            self.assertFalse("'checksum'" in info['data_file'])
+
+    def test_statistics(self):
+        stats = VolumeStats()
+        images = prefetched(self.updater.slice_images(
+                self.path, [], self.history, stats = stats))
+        self.history.add_to_data_file('statistics', stats.record)
+        infos = self.image_info(images)
+        self.assertEqual(len(infos), 9)
+        for info in infos:
+            self.assertEqual(info['data-stats'], stats.value)
+            self.assertFalse("'statistics'" in info['data_file'])
+        main = self.history.main_process().record
+        self.assertEqual(main['data_file']['statistics'], stats.record)
+
+
+class FailureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tomo_a.nc')
+        f = open(self.path, 'wb')
+        f.write('not a NetCDF file')
+        f.close()
+        self.updater = Updater('user', 'password')
+        self.updater.failure_memo = FailureMemo(os.path.join(self.dir, 'memo'))
+        self.nc3info = update_plexus.nc3info
+        self.cache_limit = FileCache.cache_limit
+
+    def tearDown(self):
+        self.updater.failure_memo.close()
+        update_plexus.nc3info = self.nc3info
+        FileCache.cache_limit = self.cache_limit
+        shutil.rmtree(self.dir)
+
+    def test_parse_error_is_unusable(self):
+        self.assertRaises(UnusableData, self.updater.read_header, self.path)
+
+    def test_cache_limit_is_unusable(self):
+        FileCache.cache_limit = 2
+        try:
+            self.updater.read_header(self.path)
+        except UnusableData, ex:
+            self.assertEqual(str(ex), "Cache limit exceeded.")
+            self.updater.note_failure(self.path, ex)
+        else:
+            self.fail("cache limit not reported as unusable data")
+        self.assertTrue(self.updater.known_failure(self.path, 'header'))
+
+    def test_transient_error_is_passed_on(self):
+        def changing(path):
+            raise RuntimeError("File changed on disk while reading.")
+        update_plexus.nc3info = changing
+        with self.assertRaises(RuntimeError) as context:
+            self.updater.read_header(self.path)
+        self.assertFalse(isinstance(context.exception, UnusableData))
+
+    def test_forget_failure(self):
+        self.updater.note_failure(self.path, UnusableData("none", 'slices'))
+        self.assertTrue(self.updater.known_failure(self.path, 'slices'))
+        self.updater.forget_failure(self.path, 'header')
+        self.assertTrue(self.updater.known_failure(self.path, 'slices'))
+        self.updater.forget_failure(self.path)
+        self.assertFalse(self.updater.known_failure(self.path, 'slices'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+A minimal thread pool with futures, for running blocking work such as
+HTTP requests concurrently while keeping the number of tasks in flight
+bounded.
+
+Typical usage:
+    pool = ThreadPool(4)
+    futures = list(pool.submit(work, item) for item in items)
+    for f in futures:
+        print f.result()
+    pool.shutdown()
+
+(Requires Python 2.6 or higher.)
+"""
+
+import heapq, Queue, sys, threading, time
+
+
+class Future:
+    """
+    Holds the eventual result of a task submitted to a ThreadPool.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_error(self, exc_info):
+        self._error = exc_info
+        self._event.set()
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self):
+        """
+        Waits for the task to finish, then returns its result or raises
+        the exception it raised.
+        """
+        # -- a timeout keeps the main thread responsive to Ctrl-C
+        while not self._event.isSet():
+            self._event.wait(1.0)
+        if self._error is not None:
+            (type, value, tb) = self._error
+            raise type, value, tb
+        return self._result
+
+
+class ThreadPool:
+    """
+    Runs tasks on a fixed number of worker threads. The constructor
+    accepts the number of <workers> and optionally the maximal number
+    <max_pending> of tasks waiting for a worker, which defaults to the
+    number of workers. Once that limit is reached, submit() blocks.
+
+    If a function <retry_policy> is given, it is called whenever a task
+    raises an exception, with the number of attempts made so far and
+    the exception info as arguments. It returns either None, in which
+    case the exception is passed on to the task's future, or a delay in
+    seconds after which the task is queued again. Workers do not wait
+    for that delay, but move on to other tasks in the meantime.
+
+    With zero workers, tasks are run immediately within submit(), and
+    retries simply sleep for the requested delay.
+    """
+
+    def __init__(self, workers, max_pending = None, retry_policy = None):
+        self.workers = workers
+        self.retry_policy = retry_policy
+        self._queue = Queue.Queue(max_pending or max(workers, 1))
+        self._deferred = []  # heap of (due time, sequence number, task)
+        self._sequence = 0
+        self._active = 0     # number of tasks submitted, but not done
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._threads = []
+        for i in range(workers):
+            self._start(self._work)
+        if workers > 0:
+            self._start(self._schedule)
+
+    def _start(self, target):
+        t = threading.Thread(target = target)
+        t.setDaemon(True)
+        t.start()
+        self._threads.append(t)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            self._run(task)
+
+    def _schedule(self):
+        # -- moves deferred tasks back into the queue once they are due
+        while True:
+            self._cond.acquire()
+            try:
+                while not (self._stopping or self._deferred):
+                    self._cond.wait()
+                if self._stopping:
+                    break
+                delay = self._deferred[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                task = heapq.heappop(self._deferred)[2]
+            finally:
+                self._cond.release()
+            self._queue.put(task)
+
+    def _run(self, task):
+        (future, fn, args, kwargs, attempts) = task
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                exc_info = sys.exc_info()
+                attempts += 1
+                delay = None
+                if self.retry_policy is not None:
+                    delay = self.retry_policy(attempts, exc_info)
+                if delay is None:
+                    self._finish(future.set_error, exc_info)
+                elif self.workers > 0:
+                    self._defer(delay, (future, fn, args, kwargs, attempts))
+                else:
+                    time.sleep(delay)
+                    continue
+            else:
+                self._finish(future.set_result, result)
+            break
+
+    def _defer(self, delay, task):
+        self._cond.acquire()
+        try:
+            self._sequence += 1
+            heapq.heappush(self._deferred,
+                           (time.time() + delay, self._sequence, task))
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _finish(self, setter, value):
+        setter(value)
+        self._cond.acquire()
+        try:
+            self._active -= 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules the call fn(*args, **kwargs) and returns a Future for
+        its result.
+        """
+        future = Future()
+        self._cond.acquire()
+        try:
+            self._active += 1
+        finally:
+            self._cond.release()
+        task = (future, fn, args, kwargs, 0)
+        if self.workers > 0:
+            self._queue.put(task)
+        else:
+            self._run(task)
+        return future
+
+    def shutdown(self):
+        """
+        Waits for all submitted tasks, including any retries, to finish
+        and stops the workers.
+        """
+        self._cond.acquire()
+        try:
+            while self._active > 0:
+                self._cond.wait(1.0)
+            self._stopping = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for i in range(self.workers):
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self.workers = 0
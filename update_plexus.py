@@ -16,20 +16,45 @@ This can be called either from the commandline or via the pattern
 (Requires Python 2.6 or higher.)
 """
 
-import math, os, os.path, re, sys, time, traceback
+import copy, math, os, os.path, re, sys, time, traceback
 
 import json
 
-from file_cache import FileCache
+from failure_memo import FailureMemo
+from file_cache import FileCache, CacheLimitExceeded
 from logger import *
-from history import History, as_json
-from make_slices import slices
-from nc3files import nc3info
-from simple_upload import Connection
+from history import History, json_chunks
+from make_image import codec_available, parse_codec
+from make_slices import slices, find_variable, DataDigest, VolumeStats
+from make_slices import IMAGE_KINDS, volume_checksum
+from make_slices import DEFAULT_SLICES, parse_slice_spec, slices_per_axis
+from manifest import UploadManifest
+from nc3files import datafiles, nc3info
+from nc3header import FormatError
+from outbox import Outbox
+from rate_limit import RateLimiter
+from scan_state import ScanState
+from simple_upload import Connection, gzipped
+from thread_pool import ThreadPool
 
 
 SLICE_SIZES = (None, (80, 80), (120, 120))
 
+# -- responses indicating that the server does not support a request
+UNSUPPORTED = (400, 404, 405, 413, 415, 422, 501)
+
+
+class UnusableData(Exception):
+    """
+    Raised when a data set cannot be processed because of its contents.
+    The attribute 'stage' is 'header' if the NetCDF header could not be
+    read and 'slices' if no volume data for making slices was found.
+    """
+    
+    def __init__(self, message, stage):
+        Exception.__init__(self, message)
+        self.stage = stage
+
 
 class Updater(Connection):
     """
@@ -48,6 +73,8 @@ class Updater(Connection):
         <dry_run>     - if True, only lists actions that would have been taken
         <mock_slices> - if True, produces placeholder images for slices
         <output>      - object to send output to (default: sys.stdout)
+        <checksum>    - hash algorithm for volume data checksums, if any
+        <upload_threads> - number of concurrent image uploads (0 = serial)
     """
     
     MAX_ERRORS = 1000
@@ -62,7 +89,9 @@ class Updater(Connection):
                  replace     = False,
                  dry_run     = False,
                  mock_slices = False,
-                 output      = sys.stdout):
+                 output      = sys.stdout,
+                 checksum    = None,
+                 upload_threads = 0):
         Connection.__init__(self,
                             user,
                             password,
@@ -75,11 +104,42 @@ class Updater(Connection):
         self.set_output(output)
         self.dry_run     = dry_run
         self.mock_slices = mock_slices
+        self.checksum    = checksum
+        # -- without workers, requests retry inline and fail fast while
+        # -- the circuit breaker is open, so the pool must not retry
+        self.uploader    = ThreadPool(upload_threads,
+                                      retry_policy = (upload_threads > 0 and
+                                                      self.retry_delay or None))
+        self.pending     = []
+        self.pool.size   = max(self.pool.size, upload_threads)
 
         self.min_age     = 0
         self.max_age     = 0
+        self.scan_state  = None
+        self.manifest    = None
+        self.reconcile_after = 0
+        self.failure_memo = None
+        self.batch_images = False
+        self.batch_rejected = False
+        self.prefetch_threads = 0
+        self.compact_json = False
+        self.compress_imports = False
+        self.gzip_rejected = False
+        self.outbox      = None
+        self.draining    = False
+        self.encode_threads = 0
+        self.compress_level = None
+        self.image_codecs = {}
+        self.tile_size   = 0
+        self.slice_spec  = None
+        self.memory_budget = 0
+        self.statistics  = False
+        self.bulk_rejected = False
+        self.listings    = {}
         
         self.error_count = 0
+        self.upload_count = 0
+        self.deferred_count = 0
         self.last_project = self.last_sample = self.last_path = None
 
     def log_error(self, text):
@@ -131,7 +191,7 @@ class Updater(Connection):
         if path != self.last_path:
             self.last_path = path
             self.output.write("    PATH %s\n" % path)
-        if name.endswith(".png") or name.endswith(".jpg"):
+        if re.search(r'\.(png|jpg|webp|zip)$', name):
             self.output.write("  ")
         self.output.write("      %-7s %s\n" % (action, name))
         self.output.flush()
@@ -139,7 +199,27 @@ class Updater(Connection):
     def known_files(self, project, sample):
         """
         Queries Plexus for the names of all files uploaded in the given
-        project and sample. Returns a list of strings.
+        project and sample. Returns a dictionary mapping names to nodes.
+        A listing prefetched via 'prefetch_listings()' is used instead
+        of a new query if available.
+        """
+        
+        seen = self.listings.pop((project, sample), None)
+        if seen is None:
+            seen = self.query_files(project, sample)
+            if seen is None:
+                return None
+
+        # -- print the result for debugging purposes
+        self.log.writeln("Found in database: (%s)" %
+                         ', '.join(k for k in seen if seen[k]['External']))
+        
+        return seen
+
+    def query_files(self, project, sample):
+        """
+        Does the actual work for 'known_files()' when nothing was
+        prefetched.
         """
         
         try:
@@ -156,21 +236,237 @@ class Updater(Connection):
             self.log_exception()
             return None
 
-        # -- extract the list of node names
+        return self.listing_nodes(response)
+
+    def listing_nodes(self, response):
+        """
+        Extracts the nodes from the parsed response to a 'stored_data'
+        request, keeping only the most relevant one for each name.
+        """
+        
         seen = {}
         for n in response.get('Nodes') or []:
             name = n['Name']
             old = seen.get(name)
             if old is None or not old['External'] or old['Date'] < n['Date']:
                 seen[name] = n
-            
-        # -- print the result for debugging purposes
-        self.log.writeln("Found in database: (%s)" %
-                         ', '.join(k for k in seen if seen[k]['External']))
+        return seen
+
+    def listing_needed(self, project, sample):
+        """
+        Guesses whether 'stored_files()' will have to ask the server
+        about the given sample, as opposed to using the local manifest.
+        """
         
-        # -- return the list of names
+        if (project, sample) in self.listings:
+            return False
+        if self.manifest is None or self.replace:
+            return True
+        last = self.manifest.last_reconciled(project, sample)
+        return last is None or (self.reconcile_after > 0 and
+                                time.time() - last > self.reconcile_after)
+
+    def prefetch_listings(self, project, paths):
+        """
+        Retrieves the Plexus listings for all sample directories among
+        <paths> within the given project ahead of time, so that they do
+        not have to be requested one by one as each sample is processed.
+        Only samples with data sets to process are considered.
+        The results are kept in 'self.listings' for 'known_files()'.
+
+        A single bulk request is tried first. If the server does not
+        support that, the listings are requested concurrently using
+        'self.prefetch_threads' threads. Listings that cannot be fetched
+        are simply left out and requested again later. Prefetching is
+        off unless that number is positive.
+        """
+        
+        if self.prefetch_threads <= 0:
+            return
+        samples = list(os.path.basename(p) for p in paths
+                       if os.access(p, os.R_OK) and self.is_sample_dir(p)
+                       if self.listing_needed(project, os.path.basename(p))
+                       if self.data_sets(p, count_deferred = False))
+        if len(samples) < 2:
+            return
+        self.log.writeln("Prefetching listings for %d samples in '%s'..."
+                         % (len(samples), project))
+
+        responses = None
+        if not self.bulk_rejected:
+            responses = self.bulk_listings(project, samples)
+        if responses is None:
+            responses = {}
+            pool = ThreadPool(self.prefetch_threads)
+            try:
+                futures = list((sample, pool.submit(self.post_info_request,
+                                                    project, sample))
+                               for sample in samples)
+                for (sample, future) in futures:
+                    try:
+                        (status, reason, response) = future.result()
+                        if status == 200:
+                            responses[sample] = json.loads(response)
+                    except KeyboardInterrupt, ex:
+                        raise ex
+                    except Exception, ex:
+                        self.log.trace("Could not prefetch '%s': %s"
+                                       % (sample, ex))
+            finally:
+                pool.shutdown()
+
+        for sample in samples:
+            if responses.get(sample) is not None:
+                self.listings[(project, sample)] = self.listing_nodes(
+                    responses[sample])
+
+    def drop_listings(self, project = None):
+        """
+        Discards the prefetched listings that were not used by
+        'known_files()', either those for the given <project> or, if
+        none is given, all of them.
+        """
+        for key in self.listings.keys():
+            if project is None or key[0] == project:
+                del self.listings[key]
+
+    def bulk_listings(self, project, samples):
+        """
+        Requests the listings for the given samples via a single bulk
+        request. Returns a dictionary mapping sample names to parsed
+        'stored_data' responses, or None if the request failed.
+        """
+        
+        try:
+            (status, reason, response) = self.post_bulk_info_request(
+                project, samples)
+            if status in UNSUPPORTED:
+                self.bulk_rejected = True
+                self.log.writeln("Bulk listing not supported (%d - %s);"
+                                 " querying samples individually."
+                                 % (status, reason))
+                return None
+            elif status != 200:
+                return None
+            return json.loads(response).get('Samples') or {}
+        except KeyboardInterrupt, ex:
+            raise ex
+        except Exception, ex:
+            self.log.trace("Bulk listing failed: %s" % ex)
+            return None
+
+    def stored_files(self, project, sample, paths):
+        """
+        Like 'known_files()', but uses the local manifest, if any,
+        instead of querying Plexus when none of the data sets at
+        <paths> has changed since it was last uploaded and the sample
+        is not due for reconciliation with the server.
+        """
+        
+        if self.manifest is not None and not self.replace:
+            last = self.manifest.last_reconciled(project, sample)
+            due = self.reconcile_after > 0 and (
+                last is None or time.time() - last > self.reconcile_after)
+            state = list(self.dataset_state(p) for p in paths)
+            if not due and self.manifest.is_current(project, sample, state):
+                self.log.writeln("Using local manifest for '%s'." % sample)
+                return self.manifest.nodes(project, sample)
+
+        seen = self.known_files(project, sample)
+        if seen is not None and self.manifest is not None:
+            self.manifest.mark_reconciled(project, sample)
         return seen
 
+    def dataset_name(self, path):
+        """
+        Returns the Plexus node name for the data set at <path>.
+        """
+        name = os.path.basename(path)
+        if name.endswith("_nc") or name.endswith(".nc"):
+            name = name[:-3]
+        return name
+
+    def dataset_state(self, path):
+        """
+        Returns the node name, modification time and size for the data
+        set at <path> as a triple.
+        """
+        stat = os.stat(path)
+        return (self.dataset_name(path), stat.st_mtime, stat.st_size)
+
+    def remember_dataset(self, project, sample, path, node, fingerprint):
+        """
+        Records the Plexus node <node> for the data set at <path> in the
+        local manifest, if any. If <fingerprint> is None, the previously
+        recorded header fingerprint is kept, as is the data checksum
+        unless a new one was computed.
+        """
+        
+        if self.manifest is None or self.dry_run:
+            return
+        if not (node.get('IdExt') or node.get('IdInt')):
+            return
+        (name, mtime, size) = self.dataset_state(path)
+        checksum = node.get('Checksum')
+        old = self.manifest.lookup(project, sample, name)
+        if old is not None:
+            if fingerprint is None:
+                fingerprint = old['fingerprint']
+            if checksum is None and fingerprint == old['fingerprint']:
+                checksum = old['checksum']
+        self.manifest.record(project, sample, name, path, mtime, size,
+                             fingerprint, node.get('IdExt'), node.get('IdInt'),
+                             node.get('Images') or [], checksum)
+
+    def read_header(self, path):
+        """
+        Returns the NetCDF header information for the data set at <path>.
+        Raises UnusableData if the header cannot be parsed or exceeds the
+        cache limit. Other errors, such as the file changing while it is
+        read, are passed on, so that they do not end up in the failure
+        memo.
+        """
+        try:
+            return nc3info(path)
+        except (FormatError, CacheLimitExceeded), ex:
+            raise UnusableData(str(ex), 'header')
+
+    def known_failure(self, path, stage):
+        """
+        Checks the failure memo, if any, to see whether processing the
+        data set at <path> failed at the given stage in an earlier scan
+        and should not be tried again yet.
+        """
+        if self.failure_memo is None or self.replace:
+            return False
+        rec = self.failure_memo.lookup(path)
+        if rec is None or rec['stage'] != stage:
+            return False
+        self.log.trace("Skipping %s for '%s': %s"
+                       % (stage, path, rec['reason']))
+        return True
+
+    def note_failure(self, path, ex):
+        """
+        Reports the UnusableData exception <ex> raised for the data set
+        at <path> and records it in the failure memo, if any.
+        """
+        if ex.stage == 'header':
+            self.log_error("Skipping item: %s" % ex)
+        else:
+            self.log.writeln("No slices made: %s" % ex)
+        if self.failure_memo is not None and not self.dry_run:
+            self.failure_memo.add(path, ex.stage, str(ex))
+
+    def forget_failure(self, path, stage = None):
+        """
+        Drops the record of an earlier failure for the data set at <path>
+        from the failure memo, if any, after it was processed successfully
+        up to the given <stage>, or in full if no stage is given.
+        """
+        if self.failure_memo is not None and not self.dry_run:
+            self.failure_memo.remove(path, stage)
+
     def upload_files(self, project, sample, time, files, attach_to = None):
         """
         Uploads the files specified by the sequence <files> of
@@ -179,8 +475,25 @@ class Updater(Connection):
         <time>. If 'self.replace' is true, Plexus is asked to replace
         existing data where necessary.
         
-        Prints the response text to 'self.output' and returns a boolean
-        indicating whether the upload was successful.
+        Prints the response text to 'self.output' and returns the
+        upload status together with the parsed response.
+        """
+        
+        return self.check_upload(self.post_files(project, sample, time,
+                                                 files, attach_to))
+
+    def post_files(self, project, sample, time, files, attach_to = None):
+        """
+        Does the actual work for 'upload_files()' up to and including
+        the request to Plexus, returning the HTTP status, reason and
+        response text. May be called from a worker thread. If there is
+        an outbox, files are queued there instead, unless it is being
+        drained.
+
+        Import data is sent gzip-compressed if so configured. If the
+        server does not accept that, the data is sent again uncompressed,
+        so it must be given as a string, an open file or an iterable that
+        can be iterated over more than once, such as a Reiterable.
         """
         
         if len(files) != 1:
@@ -188,16 +501,177 @@ class Updater(Connection):
         data = files[0][0]
         name = files[0][1]
 
+        if self.outbox is not None and not self.draining:
+            return self.queue_files(project, sample, time, data, name,
+                                    attach_to)
+
         if attach_to:
             (status, reason, response) = self.post_image(
                 project, sample, attach_to, time, data, name,
-                name[:name.find("_")], self.replace)
+                name[:name.find("_")], self.replace,
+                retry = self.uploader.retry_policy is None)
         else:
             description = "Import generated by %s\n* File: %s\n* Date: %s" % (
                 sys.argv[0], os.path.basename(name), time)
+            if self.compress_imports and not self.gzip_rejected:
+                # -- compress as the data is produced, fall back if needed
+                start = hasattr(data, 'seek') and data.tell()
+                result = self.post_import(project, sample, time,
+                                          gzipped(data), name, description,
+                                          self.replace, compressed = True)
+                trouble = import_trouble(result)
+                if trouble is None:
+                    return result
+                self.log.writeln("Compressed import rejected (%s);"
+                                 " sending uncompressed data." % trouble)
+                if start is not False:
+                    data.seek(start)
+                retried = self.post_import(project, sample, time, data, name,
+                                           description, self.replace)
+                if (result[0] in UNSUPPORTED
+                    or import_trouble(retried) is None
+                    ):
+                    # -- only the compressed form failed, so stop using it
+                    self.gzip_rejected = True
+                return retried
             (status, reason, response) = self.post_import(
                 project, sample, time, data, name, description, self.replace)
 
+        return (status, reason, response)
+
+    def queue_files(self, project, sample, time, data, name, attach_to):
+        """
+        Writes a single file for 'post_files()' to the outbox and returns
+        a result as if the server had accepted it with the status
+        'Queued'.
+        """
+        
+        meta = { 'project': project, 'sample': sample, 'time': time,
+                 'name': name }
+        if attach_to:
+            meta['kind'] = 'image'
+            meta['dataset'] = outbox_key(project, sample, attach_to['Name'])
+            meta['key'] = meta['dataset'] + '/' + name
+            meta['IdExt'] = attach_to.get('IdExt')
+            meta['IdInt'] = attach_to.get('IdInt')
+        else:
+            meta['kind'] = 'import'
+            meta['key'] = outbox_key(project, sample, self.dataset_name(name))
+        self.outbox.put(meta, data)
+        return (200, "OK", json.dumps({ 'Status': 'Queued' }))
+
+    def drain_outbox(self):
+        """
+        Uploads everything waiting in the outbox in the order it was
+        queued, removing each entry once the server has accepted it.
+        Images are sent only once the identifiers of the data set they
+        belong to are known. Entries that fail stay in the outbox for
+        the next attempt.
+        """
+        
+        entries = self.outbox.entries()
+        if not entries:
+            return
+        self.log.writeln("Draining %d uploads from outbox..." % len(entries))
+        self.log.enter()
+        self.draining = True
+        try:
+            for (id, meta) in entries:
+                if meta['kind'] == 'import':
+                    fp = self.outbox.payload(id)
+                    try:
+                        count = self.upload_count
+                        _, res = self.upload_files(meta['project'],
+                                                   meta['sample'],
+                                                   meta['time'],
+                                                   ((fp, meta['name']),))
+                    finally:
+                        fp.close()
+                    if self.upload_count > count:
+                        self.outbox.set_node(meta['key'],
+                                             res.get('MainNodeExternalID'),
+                                             res.get('MainNodeID'))
+                        self.outbox.remove(id)
+                else:
+                    attach_to = self.outbox.node(meta['dataset'])
+                    if meta['IdExt'] or meta['IdInt']:
+                        attach_to = meta
+                    if not attach_to:
+                        self.log.writeln("Data set for %s not uploaded yet."
+                                         % meta['name'])
+                        continue
+                    fp = self.outbox.payload(id)
+                    try:
+                        data = fp.read()
+                    finally:
+                        fp.close()
+                    future = self.uploader.submit(
+                        self.post_files, meta['project'], meta['sample'],
+                        meta['time'], ((data, meta['name']),), attach_to)
+                    self.pending.append((meta['name'], future,
+                                         outbox_removal(self.outbox, id)))
+                    self.collect_uploads(wait = False)
+            self.collect_uploads()
+        except KeyboardInterrupt, ex:
+            raise ex
+        except:
+            self.log_exception("Stopped draining the outbox.")
+        self.collect_uploads()
+        self.draining = False
+        self.log.leave()
+
+    def post_batch(self, project, sample, time, files, attach_to):
+        """
+        Uploads the images specified by the sequence <files> of (data,
+        name) pairs for the dataset <attach_to> in a single request. If
+        the server rejects the batch, this and all further images are
+        uploaded one at a time instead.
+
+        Returns a dictionary mapping each image name to a result in the
+        form produced by 'post_files()'. May be called from a worker
+        thread.
+        """
+        
+        if not self.batch_rejected:
+            images = list((data, name, name[:name.find("_")])
+                          for (data, name) in files)
+            retry = self.uploader.retry_policy is None
+            result = self.post_images(project, sample, attach_to, time,
+                                      images, self.replace, retry = retry)
+            if result[0] not in UNSUPPORTED:
+                return self.split_batch(files, result)
+            self.batch_rejected = True
+            self.log.writeln("Batch upload rejected (%d - %s);"
+                             " uploading images one at a time." % result[:2])
+
+        return dict((name, self.post_files(project, sample, time,
+                                           ((data, name),), attach_to))
+                    for (data, name) in files)
+
+    def split_batch(self, files, result):
+        """
+        Splits the <result> of a batch upload into individual results
+        for the images in <files>, as described for 'post_batch()'.
+        """
+        
+        (status, reason, response) = result
+        if status != 200:
+            return dict((name, result) for (data, name) in files)
+
+        output = json.loads(response)
+        parts = dict((part.get('Name'), part)
+                     for part in output.get('Pictures') or [])
+        return dict((name, (status, reason,
+                            json.dumps(parts.get(name, output))))
+                    for (data, name) in files)
+
+    def check_upload(self, result):
+        """
+        Interprets the result of 'post_files()' and reports it as
+        described for 'upload_files()'.
+        """
+        
+        (status, reason, response) = result
         bad = False
         if status == 200:
             output = json.loads(response)
@@ -219,69 +693,222 @@ class Updater(Connection):
         if bad:
             self.log_error("Upload failed: " + status)
         else:
+            self.upload_count += 1
             self.log.writeln("Upload okay: " + status)
         
         return status, output
 
+    def collect_uploads(self, wait = True):
+        """
+        Checks the results of the uploads in 'self.pending' in the order
+        they were submitted and runs the callbacks attached to them with
+        a boolean indicating success. Unless <wait> is true, stops at the
+        first upload still in progress. Images uploaded as a batch share
+        a future, whose result is looked up by image name.
+        """
+        
+        while self.pending:
+            (name, future, callback) = self.pending[0]
+            if future is not None and not (wait or future.done()):
+                break
+            del self.pending[0]
+            try:
+                count = self.upload_count
+                if future is not None:
+                    result = future.result()
+                    if isinstance(result, dict):
+                        result = result[name]
+                    self.check_upload(result)
+                callback(future is None or self.upload_count > count)
+            except KeyboardInterrupt, ex:
+                raise ex
+            except:
+                self.log_exception("Could not complete upload of %s." % name)
+
+    def when_uploaded(self, name, callback):
+        """
+        Runs <callback> once all uploads submitted so far are done.
+        """
+        self.pending.append((name, None, callback))
+        self.collect_uploads(wait = False)
+
     def slices_missing(self, seen, sizes_wanted):
-        patterns = list(re.sub(r'(.*slice[XYZ]).*', r'\1', name)
-                        for name in seen)
-        for size in sizes_wanted:
+        # -- count distinct images per kind, whatever their codec
+        counts = {}
+        for stem in set(os.path.splitext(name)[0] for name in seen):
+            pattern = re.sub(r'(.*slice[XYZ]).*', r'\1', stem)
+            counts[pattern] = counts.get(pattern, 0) + 1
+        wanted = slices_per_axis(self.slice_spec or DEFAULT_SLICES)
+        prefixes = list(("__%sx%s__" % size) if size else ""
+                        for size in sizes_wanted)
+        if self.tile_size > 0:
+            prefixes.append("__tiles__")
+        for prefix in prefixes:
             for axis in 'XYZ':
-                if size is None:
-                    name = "slice%s" % (axis,)
-                else:
-                    (u, v) = size
-                    name = "__%sx%s__slice%s" % (u, v, axis)
-                if not name in patterns:
+                if counts.get("%sslice%s" % (prefix, axis), 0) < wanted[axis]:
                     return True
         return False
 
+    def slice_images(self, path, seen, history = None, digest = None,
+                     stats = None):
+        """
+        Returns a generator producing the slice images for the NetCDF
+        data set at location <path>, as described for 'slices()' in
+        make_slices, with <seen> the list of existing images. Image
+        metadata is taken from <history> if given, or else extracted
+        anew. If <digest> is given, a checksum of the volume is computed,
+        and if <stats> is given, statistics are collected. These only
+        reach the image metadata as 'data-checksum' and 'data-stats'.
+        """
+
+        if history is None:
+            history = History(self.read_header(path), path,
+                              time.gmtime(os.path.getmtime(path)))
+        entries = datafiles(path)
+        if not entries or find_variable(entries[0]) is None:
+            raise UnusableData("No appropriate volume data found.", 'slices')
+        # -- copy, so that later additions to the history, such as the
+        # -- checksum, do not reach images that are still being made
+        main = copy.deepcopy(history.main_process().record)
+        meta = dict((k, main[k]) for k in ["data_file",
+                                           "data_type",
+                                           "date",
+                                           "domain",
+                                           "identifier",
+                                           "name",
+                                           "predecessors",
+                                           "process",
+                                           "run_by"])
+        meta['path'] = os.path.abspath(path)
+
+        return slices(path, seen, self.replace, self.mock_slices,
+                      sizes = SLICE_SIZES, info = meta, digest = digest,
+                      encoders = self.encode_threads,
+                      compress_level = self.compress_level,
+                      codecs = self.image_codecs,
+                      tile_size = self.tile_size,
+                      slice_spec = self.slice_spec,
+                      memory_budget = self.memory_budget,
+                      stats = stats)
+
     def update_slices(self, path, project = None, sample = None,
-                      info = None, timestring = None):
+                      info = None, timestring = None, images = None):
         """
         Creates and uploads slice images for a single NetCDF data set at
         location <path>. If <project> and <sample> are not specified,
         they are extracted from the absolute path. Additional information
-        is passed in <info> and <timestring>.
+        is passed in <info> and <timestring>. If the images were already
+        started by 'slice_images()', the generator is passed in <images>.
         
         The response received from Plexus is written to self.output.
         """
 
-        if not (info.get('IdExt') or info.get('IdInt')):
+        if not (info.get('IdExt') or info.get('IdInt') or info.get('Queued')):
             return
 
         seen = info['Images']
 
-        if self.slices_missing(seen, SLICE_SIZES):
+        if images is not None or self.slices_missing(seen, SLICE_SIZES):
             if self.dry_run:
-                s = slices(path, seen, self.replace, true)
+                s = slices(path, seen, self.replace, True,
+                           codecs = self.image_codecs,
+                           tile_size = self.tile_size,
+                           slice_spec = self.slice_spec)
                 for (data, name, action) in s:
                     self.print_action(project, sample, os.path.dirname(path),
                                       name, action)
             else:
-                history = History(nc3info(path), path,
-                                  time.gmtime(os.path.getmtime(path)))
-                main = history.main_process().record
-                meta = dict((k, main[k]) for k in ["data_file",
-                                                   "data_type",
-                                                   "date",
-                                                   "domain",
-                                                   "identifier",
-                                                   "name",
-                                                   "predecessors",
-                                                   "process",
-                                                   "run_by"])
-                meta['path'] = os.path.abspath(path)
-
-                s = slices(path, seen, self.replace, self.mock_slices,
-                           sizes = SLICE_SIZES, info = meta)
-                for (data, name, action) in s:
-                    self.upload_files(project, sample, timestring,
-                                      ((data, name),), info)
+                digest = None
+                if images is None:
+                    if self.checksum:
+                        digest = DataDigest(self.checksum)
+                    stats = VolumeStats() if self.statistics else None
+                    images = self.slice_images(path, seen, digest = digest,
+                                               stats = stats)
+
+                if (self.batch_images and not self.batch_rejected and
+                    self.outbox is None):
+                    # -- send all images for this data set in one go
+                    files = list((data, name) for (data, name, action)
+                                 in images)
+                    if files:
+                        future = self.uploader.submit(
+                            self.post_batch, project, sample, timestring,
+                            files, info)
+                    for (data, name) in files:
+                        self.pending.append((name, future,
+                                             image_added(seen, name)))
+                    self.collect_uploads(wait = False)
+                else:
+                    # -- hand images to the upload workers as they are made
+                    for (data, name, action) in images:
+                        future = self.uploader.submit(
+                            self.post_files, project, sample, timestring,
+                            ((data, name),), info)
+                        self.pending.append((name, future,
+                                             image_added(seen, name)))
+                        self.collect_uploads(wait = False)
+
+                if digest is not None and digest.value:
+                    info['Checksum'] = digest.value
         else:
             self.log.info("Slices look complete. Skipped slice generation.")
 
+    def content_changed(self, project, sample, path, node):
+        """
+        Decides whether the data set at <path> differs from the version
+        described by the Plexus node <node>. Returns a pair consisting
+        of the decision and the header fingerprint, if one was computed.
+
+        Data sets not modified after the date stored with the node are
+        unchanged. For newer ones, the header fingerprint is compared
+        against the one recorded in the local manifest or, failing that,
+        reported by the server, so that merely touching or copying a
+        file does not cause it to be uploaded and sliced again. If no
+        previous fingerprint is known, the data set counts as changed.
+
+        If data checksums are enabled and one was recorded for the
+        previous version, an unchanged header is not enough: the volume
+        data is read and its checksum compared as well. To do this only
+        once, data sets whose modification time and size match the ones
+        in the manifest count as unchanged right away, since that version
+        was uploaded or verified before.
+        """
+        
+        new_time = time.strftime("%Y/%m/%d %H:%M:%S UTC",
+                                 time.gmtime(os.path.getmtime(path)))
+        if not node["Date"] < new_time:
+            return False, None
+
+        known = node.get('Fingerprint')
+        checksum = node.get('Checksum')
+        if self.manifest is not None:
+            (name, mtime, size) = self.dataset_state(path)
+            rec = self.manifest.lookup(project, sample, name)
+            if rec and rec['mtime'] == mtime and rec['size'] == size:
+                return False, rec['fingerprint']
+            if rec and rec['fingerprint']:
+                known = rec['fingerprint']
+            if rec and rec['checksum']:
+                checksum = rec['checksum']
+        if not known:
+            return True, None
+
+        fingerprint = self.read_header(path).fingerprint
+        if fingerprint != known:
+            return True, fingerprint
+
+        if self.checksum and checksum:
+            # -- use the algorithm the recorded checksum was made with
+            algorithm = checksum.split(':')[0]
+            if volume_checksum(path, algorithm,
+                               self.memory_budget) != checksum:
+                self.log.writeln("Data changed despite unchanged header.")
+                return True, fingerprint
+
+        self.log.writeln("Header unchanged despite newer date.")
+        return False, fingerprint
+
     def update_item(self, path, project = None, sample = None, seen = None):
         """
         Uploads the data for a single NetCDF data set at location
@@ -311,15 +938,19 @@ class Updater(Connection):
 
         # -- extract other relevant information
         location = os.path.dirname(path)
-        if name.endswith("_nc") or name.endswith(".nc"):
-            name = name[:-3]
+        name = self.dataset_name(path)
+        fingerprint = None
+        if self.known_failure(path, 'header'):
+            return
+        want_slices = self.make_slices and not self.known_failure(path,
+                                                                  'slices')
         self.log.writeln("Processing item '%s'..." % name)
         self.log.enter()
 
         try:
             # -- determine list of nodes known to Plexus, if not given
             if seen is None:
-                seen = self.known_files(project, sample)
+                seen = self.stored_files(project, sample, [path])
                 if seen is None:
                     self.log.writeln("Unable to contact Plexus - giving up.",
                                      LOGGER_ERROR)
@@ -328,15 +959,14 @@ class Updater(Connection):
     
             # -- determine which action to take
             if name in seen.keys():
-                old_time = seen[name]["Date"]
-                new_time = time.strftime("%Y/%m/%d %H:%M:%S UTC",
-                                         time.gmtime(mtime))
-                if old_time < new_time:
+                (changed, fingerprint) = self.content_changed(
+                    project, sample, path, seen[name])
+                if changed:
                     seen[name]['Images'] = []
                 if not seen[name]['External']:
                     self.log.writeln("Updating metadata...")
                     action = "UPDATE"
-                elif self.replace or old_time < new_time:
+                elif self.replace or changed:
                     self.log.writeln("Replacing metadata...")
                     action = "REPLACE"
                 else:
@@ -346,37 +976,146 @@ class Updater(Connection):
                 self.log.writeln("Adding metadata...")
                 action = "ADD"
             
-            # -- extract and upload the header data if appropriate
+            # -- account for uploads still waiting in the outbox
             t = time.strftime("%Y/%m/%d %H:%M:%S UTC", time.gmtime(mtime))
-            seen.setdefault(name, { 'Images': [] })
+            seen.setdefault(name, { 'Name': name, 'Images': [] })
+            if self.outbox is not None:
+                key = outbox_key(project, sample, name)
+                queued = self.outbox.pending(key)
+                if queued is not None and queued['time'] == t:
+                    self.log.writeln("Metadata already queued for upload.")
+                    seen[name]['Queued'] = True
+                    action = "SKIP"
+                for image in self.outbox.pending_images(key):
+                    if image not in seen[name]['Images']:
+                        seen[name]['Images'].append(image)
+
+            # -- extract and upload the header data if appropriate
+            images = None
             if action != "SKIP":
                 if self.dry_run:
                     self.print_action(project, sample, location, name, action)
                 else:
-                    h = History(nc3info(path), path, time.gmtime(mtime))
-                    data = as_json(h)
+                    header = self.read_header(path)
+                    fingerprint = header.fingerprint
+                    h = History(header, path, time.gmtime(mtime))
+                    if (want_slices and (self.checksum or self.statistics)
+                        and self.slices_missing(seen[name]['Images'],
+                                                SLICE_SIZES)
+                        ):
+                        # -- read the volume first to include its checksum
+                        # -- and statistics
+                        digest = stats = None
+                        if self.checksum:
+                            digest = DataDigest(self.checksum)
+                        if self.statistics:
+                            stats = VolumeStats()
+                        try:
+                            images = prefetched(self.slice_images(
+                                    path, seen[name]['Images'], h, digest,
+                                    stats))
+                        except UnusableData, ex:
+                            self.note_failure(path, ex)
+                            want_slices = False
+                        if digest is not None and digest.value:
+                            seen[name]['Checksum'] = digest.value
+                            h.add_to_data_file('checksum', digest.value)
+                        if stats is not None and stats.record is not None:
+                            h.add_to_data_file('statistics', stats.record)
+                    data = Reiterable(json_chunks, h, self.compact_json)
+                    count = self.upload_count
                     _, res = self.upload_files(project, sample,
                                                t, ((data, path),))
                     seen[name]['IdExt'] = res.get('MainNodeExternalID')
                     seen[name]['IdInt'] = res.get('MainNodeID')
+                    seen[name]['Queued'] = res.get('Status') == 'Queued'
+                    if self.upload_count == count:
+                        # -- the server's copy is not current
+                        fingerprint = False
     
             self.log.writeln(str(seen[name]))
 
             # -- extract and upload the slices if appropriate
-            if self.make_slices:
-                self.update_slices(path, project, sample, seen[name], t)
+            if want_slices:
+                try:
+                    self.update_slices(path, project, sample, seen[name], t,
+                                       images)
+                except UnusableData, ex:
+                    self.note_failure(path, ex)
+                    want_slices = False
+
+            # -- forget earlier failures that did not happen again
+            if want_slices:
+                self.forget_failure(path)
+            else:
+                self.forget_failure(path, 'header')
+
+            # -- remember what is now stored on the server
+            if fingerprint is not False:
+                node = seen[name]
+                self.when_uploaded(name, lambda ok: self.remember_dataset(
+                        project, sample, path, node, fingerprint))
 
         except KeyboardInterrupt, ex:
             raise ex
+        except UnusableData, ex:
+            self.note_failure(path, ex)
         except:
             self.log_exception("Skipping item because of errors.")
 
         self.log.leave()
 
-    def age_okay(self, path):
+    def data_sets(self, path, count_deferred = True):
+        """
+        Returns the paths of all potential data sets to be processed in
+        the directory at <path>. If <count_deferred> is false, data sets
+        that are too young for now are not counted as deferred.
+        """
+        return list(os.path.join(path, f)
+                    for f in os.listdir(path)
+                    if self.has_volume_data(f)
+                    if not self.known_failure(os.path.join(path, f), 'header')
+                    if not f.startswith('analysis_')
+                    if not f.startswith('fiducial')
+                    if not f.startswith('experiment')
+                    if not f.startswith('block0')
+                    if self.age_okay(os.path.join(path, f), count_deferred))
+
+    def age_okay(self, path, count_deferred = True):
         age = time.time() - os.path.getmtime(path)
-        return (self.max_age == 0
-                or age <= self.max_age) and age >= self.min_age
+        if age < self.min_age:
+            # -- too young for now, so the directory must be looked at again
+            if count_deferred:
+                self.deferred_count += 1
+            return False
+        return self.max_age == 0 or age <= self.max_age
+
+    def subtree_unchanged(self, path):
+        """
+        Checks whether the directory at <path> and everything under it
+        is unchanged since it was last processed without errors. Always
+        false if no scan state is kept or if files are to be replaced.
+        """
+        if self.scan_state is None or self.replace:
+            return False
+        return self.scan_state.unchanged(path)
+
+    def counters(self):
+        return (self.error_count, self.deferred_count, self.upload_count)
+
+    def record_subtree(self, path, before, subdirs = (), leaves = ()):
+        """
+        Records the state of the directory at <path> in the scan state,
+        if any. The triple <before> holds the values returned by
+        'counters()' before the directory was processed.
+        """
+        if self.scan_state is None or self.dry_run:
+            return
+        self.collect_uploads()
+        (errors, deferred, uploads) = self.counters()
+        complete = errors == before[0] and deferred == before[1]
+        self.scan_state.record(path, complete, uploads - before[2],
+                               subdirs, leaves)
 
     def update_container(self, path, project = None, sample = None,
                          seen = None):
@@ -399,17 +1138,16 @@ class Updater(Connection):
         project = project or os.path.basename(os.path.dirname(path))
         sample = sample or os.path.basename(path)
         
+        if self.subtree_unchanged(path):
+            self.log.writeln("Skipping unchanged %s '%s'."
+                             % (kind, os.path.basename(path)))
+            return
+        before = self.counters()
+
         try:
             if os.access(path, os.R_OK):
                 # -- compose list of potential data sets under this directory
-                entries =  list(os.path.join(path, f)
-                                for f in os.listdir(path)
-                                if self.has_volume_data(f)
-                                if not f.startswith('analysis_')
-                                if not f.startswith('fiducial')
-                                if not f.startswith('experiment')
-                                if not f.startswith('block0')
-                                if self.age_okay(os.path.join(path, f)))
+                entries = self.data_sets(path)
 
                 if entries:
                     if kind == "sample":
@@ -421,13 +1159,17 @@ class Updater(Connection):
                     self.log.enter()
                     # -- get the list of known data sets from Plexus
                     if seen is None:
-                        seen = self.known_files(project, sample)
+                        seen = self.stored_files(project, sample, entries)
             
                     # -- call update_item to handle each data set
                     for file in entries:
                         self.update_item(file, project, sample, seen)
             
                     self.log.leave()
+
+                # -- remember the state of this directory for the next scan
+                self.record_subtree(path, before,
+                                    leaves = self.subdirectories(path))
             else:
                 # -- directory has no read access
                 self.log_error("cannot access " + path)
@@ -440,13 +1182,26 @@ class Updater(Connection):
         path = os.path.abspath(path)
         project = project or os.path.basename(path)
         
+        if self.subtree_unchanged(path):
+            self.log.writeln("Skipping unchanged project '%s'." % project)
+            return
+        before = self.counters()
+
         try:
             if os.access(path, os.R_OK):
                 self.log.writeln("Processing project '%s'..." % project)
                 self.log.enter()
-                for name in os.listdir(path):
-                    self.update_sample(os.path.join(path, name), project)
+                self.prefetch_listings(project, list(
+                        p for p in self.subdirectories(path)
+                        if not self.subtree_unchanged(p)))
+                try:
+                    for name in os.listdir(path):
+                        self.update_sample(os.path.join(path, name), project)
+                finally:
+                    self.drop_listings(project)
                 self.log.leave()
+                self.record_subtree(path, before,
+                                    subdirs = self.subdirectories(path))
             else:
                 self.log_error("cannot access " + path)
         except KeyboardInterrupt, ex:
@@ -458,6 +1213,11 @@ class Updater(Connection):
         path = os.path.abspath(path)
         repo = os.path.basename(path)
         
+        if self.subtree_unchanged(path):
+            self.log.writeln("Skipping unchanged repository '%s'." % repo)
+            return
+        before = self.counters()
+
         try:
             if os.access(path, os.R_OK):
                 self.log.writeln("Processing repository '%s'..." % repo)
@@ -465,6 +1225,8 @@ class Updater(Connection):
                 for name in os.listdir(path):
                     self.update_project(os.path.join(path, name))
                 self.log.leave()
+                self.record_subtree(path, before,
+                                    subdirs = self.subdirectories(path))
             else:
                 self.log_error("cannot access " + path)
         except KeyboardInterrupt, ex:
@@ -480,6 +1242,14 @@ class Updater(Connection):
         return (path.endswith(".nc") or path.endswith("_nc") or
                 path.endswith(".nc.bz2") or path.endswith("_nc.bz2"))
 
+    def subdirectories(self, path):
+        """
+        Returns the list of full paths for all subdirectories of the
+        directory <path>.
+        """
+        return list(os.path.join(path, f) for f in os.listdir(path)
+                    if os.path.isdir(os.path.join(path, f)))
+
     def is_sample_dir(self, path):
         """
         Checks the directory name <path> to see if the specified
@@ -524,7 +1294,16 @@ class Updater(Connection):
         else:
             # -- recursively look for sample directories
             for (root, dirs, files) in os.walk(path):
-                if self.is_sample_dir(root):
+                # -- skip subtrees already known to be unchanged
+                dirs[:] = list(d for d in dirs if not self.subtree_unchanged(
+                        os.path.join(root, d)))
+                if not self.is_sample_dir(root):
+                    # -- get server listings for samples right below
+                    self.drop_listings()
+                    self.prefetch_listings(os.path.basename(root),
+                                           list(os.path.join(root, d)
+                                                for d in dirs))
+                else:
                     # -- upload sample data
                     self.update_sample(root)
                     # -- ignore subdirectories further down
@@ -534,15 +1313,27 @@ class Updater(Connection):
                         self.log.writeln("Too many files opened - terminating.",
                                          LOGGER_WARNING)
                         break
+            self.drop_listings()
 
     def close(self):
         """
-        Flushes and - if appropriate - closes the output channel for
-        this instance.
+        Closes any open server connections, then flushes and - if
+        appropriate - closes the output channel for this instance.
         """
+        self.collect_uploads()
+        self.uploader.shutdown()
+        Connection.close(self)
         self.output.flush()
         if not self.output in (sys.stdout, sys.stderr):
             self.output.close()
+        if self.scan_state is not None:
+            self.scan_state.close()
+        if self.manifest is not None:
+            self.manifest.close()
+        if self.failure_memo is not None:
+            self.failure_memo.close()
+        if self.outbox is not None:
+            self.outbox.close()
 
     @property
     def output(self):
@@ -553,6 +1344,79 @@ class Updater(Connection):
         self.log.stream = stream
 
 
+def image_added(images, name):
+    """
+    Returns an upload callback that adds <name> to the list <images>
+    if the upload was successful.
+    """
+    def callback(ok):
+        if ok and name not in images:
+            images.append(name)
+    return callback
+
+
+def outbox_removal(outbox, id):
+    """
+    Returns an upload callback that removes the entry with the given id
+    from <outbox> if the upload was successful.
+    """
+    def callback(ok):
+        if ok:
+            outbox.remove(id)
+    return callback
+
+
+def outbox_key(project, sample, name):
+    """
+    Returns the key identifying the data set <name> in an outbox.
+    """
+    return "%s/%s/%s" % (project, sample, name)
+
+
+def import_trouble(result):
+    """
+    Checks the <result> of a request to the '/imports' service for a
+    sign that the server could not handle it, and returns a description
+    of the problem, or None if there is none.
+    """
+    (status, reason, response) = result
+    if status in UNSUPPORTED:
+        return "%d - %s" % (status, reason.replace("\n", ""))
+    if status == 200:
+        try:
+            if json.loads(response).get('Status') == 'Error':
+                return "status 'Error'"
+        except (ValueError, AttributeError):
+            pass
+    return None
+
+
+class Reiterable:
+    """
+    An iterable that calls fn(*args) for each iteration to obtain a new
+    iterator, so that generated data can be produced again, as needed
+    for retries.
+    """
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __iter__(self):
+        return iter(self.fn(*self.args))
+
+
+def prefetched(items):
+    """
+    Retrieves the first element of the iterable <items>, thus starting
+    any work a generator has to do up front, and returns an iterator
+    over all of its elements.
+    """
+    import itertools
+
+    items = iter(items)
+    return itertools.chain(list(itertools.islice(items, 1)), items)
+
+
 def parse_options():
     """
     Parses commandline arguments and options as passed via sys.argv.
@@ -581,6 +1445,14 @@ def parse_options():
     parser.add_option("-n", "--dry-run", dest = "dry_run", default = False,
                       action = "store_true",
                       help = "do nothing, only print actions")
+    parser.add_option("", "--checksum", dest = "checksum", metavar = "ALGO",
+                      help = "compute data checksums (md5, sha256, xxhash)")
+    parser.add_option("", "--compact-json", dest = "compact_json",
+                      default = False, action = "store_true",
+                      help = "upload metadata as JSON without indentation")
+    parser.add_option("", "--compress-imports", dest = "compress_imports",
+                      default = False, action = "store_true",
+                      help = "upload metadata gzip-compressed")
     parser.add_option("", "--mock-slices", dest = "mock_slices",
                       default = False, action = "store_true",
                       help = "skip slice generation and upload test images")
@@ -594,7 +1466,54 @@ def parse_options():
                       help = "how often to retry connecting to Plexus")
     parser.add_option("", "--retry-wait", dest = "retry_wait", metavar = "NR",
                       default = 0, type = "int",
-                      help = "waiting period (sec) before retrying a connection")
+                      help = "maximal waiting period (sec) before a retry")
+    parser.add_option("", "--timeout", dest = "timeout", metavar = "NR",
+                      default = 0, type = "int",
+                      help = "time limit (sec) for each request to Plexus")
+    parser.add_option("", "--info-rate", dest = "info_rate", metavar = "NR",
+                      default = 0, type = "float",
+                      help = "maximal number of queries to Plexus per second")
+    parser.add_option("", "--upload-rate", dest = "upload_rate", metavar = "NR",
+                      default = 0, type = "float",
+                      help = "maximal number of uploads per second")
+    parser.add_option("", "--upload-bandwidth", dest = "upload_bandwidth",
+                      metavar = "KB", default = 0, type = "int",
+                      help = "maximal upload volume per second (kilobytes)")
+    parser.add_option("", "--batch-images", dest = "batch_images",
+                      default = False, action = "store_true",
+                      help = "upload all images for a data set in one request")
+    parser.add_option("", "--prefetch-threads", dest = "prefetch_threads",
+                      metavar = "NR", default = 0, type = "int",
+                      help = "concurrent queries when prefetching listings "
+                      + "(default 0 = no prefetching)")
+    parser.add_option("", "--encode-threads", dest = "encode_threads",
+                      metavar = "NR", default = 0, type = "int",
+                      help = "number of images to encode concurrently")
+    parser.add_option("", "--png-compression", dest = "compress_level",
+                      metavar = "NR", type = "int",
+                      help = "zlib level for PNG images (0 = fastest, 9)")
+    parser.add_option("", "--image-codec", dest = "image_codecs",
+                      metavar = "KIND=CODEC[:QUALITY]", default = [],
+                      action = "append",
+                      help = "codec (png, jpeg, webp) for tomo, segmented, "
+                      + "labels or thumbnail images (repeatable; jpeg and "
+                      + "webp need Pillow 6.0 or later)")
+    parser.add_option("", "--tile-size", dest = "tile_size", metavar = "NR",
+                      default = 0, type = "int",
+                      help = "also upload zoomable slices in tiles of NR pixels")
+    parser.add_option("", "--slices", dest = "slice_spec", metavar = "SPEC",
+                      help = "slices to make, e.g. 'x*3,z@1200+5,y:max' for "
+                      + "three x slices, a 5 voxel thick z slab at z = 1200 "
+                      + "and the maximum projection along y")
+    parser.add_option("", "--statistics", dest = "statistics",
+                      default = False, action = "store_true",
+                      help = "record volume statistics with the metadata")
+    parser.add_option("", "--memory-budget", dest = "memory_budget",
+                      metavar = "MB", default = 0, type = "int",
+                      help = "memory for reading volume data (megabytes)")
+    parser.add_option("", "--upload-threads", dest = "upload_threads",
+                      metavar = "NR", default = 0, type = "int",
+                      help = "number of images to upload concurrently")
     parser.add_option("", "--max-files", dest = "max_files", metavar = "NR",
                       default = 100, type = "int",
                       help = "limits the number of uncached NetCDF file reads")
@@ -605,6 +1524,27 @@ def parse_options():
                       metavar = "PATH", help = "where to cache NetCDF headers")
     parser.add_option("", "--cache-root", dest = "cache_root", metavar = "PATH",
                       help = "ignored initial path segment for cache lookup")
+    parser.add_option("", "--scan-state", dest = "scan_state", metavar = "PATH",
+                      help = "where to record directories already scanned")
+    parser.add_option("", "--manifest", dest = "manifest", metavar = "PATH",
+                      help = "where to record data sets already uploaded")
+    parser.add_option("", "--reconcile-after", dest = "reconcile_after",
+                      metavar = "AGE",
+                      help = "how often to check the manifest against Plexus")
+    parser.add_option("", "--outbox", dest = "outbox", metavar = "PATH",
+                      help = "directory to queue uploads in")
+    parser.add_option("", "--queue-only", dest = "queue_only",
+                      default = False, action = "store_true",
+                      help = "fill the outbox, but do not upload from it")
+    parser.add_option("", "--drain-only", dest = "drain_only",
+                      default = False, action = "store_true",
+                      help = "only upload what is waiting in the outbox")
+    parser.add_option("", "--failure-memo", dest = "failure_memo",
+                      metavar = "PATH",
+                      help = "where to record data sets that could not be read")
+    parser.add_option("", "--retry-failures-after", dest = "retry_failures",
+                      metavar = "AGE", default = "7 days",
+                      help = "when to try unreadable data sets again")
     parser.add_option("", "--max-age", dest = "max_age", metavar = "AGE",
                       help = "maximal file age in seconds or specified unit")
     parser.add_option("", "--min-age", dest = "min_age", metavar = "AGE",
@@ -619,8 +1559,42 @@ def parse_options():
                       action = "store_const", const = "dataset")
     
     (options, args) = parser.parse_args()
-    if len(args) < 1:
+    if (options.queue_only or options.drain_only) and not options.outbox:
+        parser.error("no outbox specified")
+    if len(args) < 1 and not options.drain_only:
         parser.error("expecting at least one argument")
+
+    # -- make sure the checksum algorithm can be used
+    if options.checksum:
+        try:
+            DataDigest(options.checksum)
+        except ImportError:
+            parser.error("checksum '%s' requires the %s package"
+                         % (options.checksum, options.checksum))
+        except ValueError:
+            parser.error("unknown checksum algorithm '%s'" % options.checksum)
+
+    # -- turn codec specifications into a policy
+    codecs = {}
+    for spec in options.image_codecs:
+        (kind, sep, codec) = spec.partition('=')
+        if kind not in set(IMAGE_KINDS.values()) | set(['thumbnail']):
+            parser.error("unknown image kind '%s' in '%s'" % (kind, spec))
+        try:
+            codecs[kind] = parse_codec(codec)
+        except ValueError, ex:
+            parser.error(str(ex))
+        if not codec_available(codecs[kind][0]):
+            parser.error("codec '%s' not supported by the installed PIL"
+                         " (JPEG and WebP need Pillow 6.0 or later)"
+                         % codecs[kind][0])
+    options.image_codecs = codecs
+
+    if options.slice_spec is not None:
+        try:
+            options.slice_spec = parse_slice_spec(options.slice_spec)
+        except ValueError, ex:
+            parser.error(str(ex))
     
     return options, args
 
@@ -668,7 +1642,9 @@ def run():
                       make_slices = options.make_slices,
                       replace     = options.force,
                       dry_run     = options.dry_run,
-                      mock_slices = options.mock_slices)
+                      mock_slices = options.mock_slices,
+                      checksum    = options.checksum,
+                      upload_threads = options.upload_threads)
     
     if options.output != "-":
         updater.set_output(open(options.output, "a"))
@@ -676,6 +1652,26 @@ def run():
         updater.retry_limit = options.retry_limit
     if options.retry_wait > 0:
         updater.retry_wait = options.retry_wait
+        updater.retry_base = min(updater.retry_base, options.retry_wait)
+    if options.timeout > 0:
+        updater.pool.timeout = options.timeout
+    updater.limits['info'] = RateLimiter(requests = options.info_rate)
+    updater.limits['upload'] = RateLimiter(
+        requests = options.upload_rate,
+        bytes = options.upload_bandwidth * 1024,
+        max_concurrency = max(options.upload_threads, 1))
+    
+    updater.batch_images = options.batch_images
+    updater.prefetch_threads = options.prefetch_threads
+    updater.compact_json = options.compact_json
+    updater.encode_threads = options.encode_threads
+    updater.compress_level = options.compress_level
+    updater.image_codecs = options.image_codecs
+    updater.tile_size = options.tile_size
+    updater.slice_spec = options.slice_spec
+    updater.memory_budget = options.memory_budget * 1024 * 1024
+    updater.statistics = options.statistics
+    updater.compress_imports = options.compress_imports
     
     # -- process cache options
     FileCache.cache_location = options.cache_location
@@ -686,16 +1682,43 @@ def run():
     updater.min_age = parse_age(options.min_age)
     updater.max_age = parse_age(options.max_age)
     
+    # -- open the scan state, if any, to skip unchanged directories
+    if options.scan_state:
+        updater.scan_state = ScanState(options.scan_state)
+    
+    # -- open the upload manifest, if any, to avoid needless server queries
+    if options.manifest:
+        updater.manifest = UploadManifest(options.manifest)
+        updater.reconcile_after = parse_age(options.reconcile_after)
+    
+    # -- open the failure memo, if any, to skip known bad data sets
+    if options.failure_memo:
+        updater.failure_memo = FailureMemo(options.failure_memo,
+                                           parse_age(options.retry_failures))
+    
+    # -- open the outbox, if any, to queue uploads on disk
+    if options.outbox:
+        updater.outbox = Outbox(options.outbox)
+    
     # -- log start time
     updater.log.writeln("Scan started at %s" % time.ctime())
     
     # -- upload data from the given paths
-    for path in args:
-        updater.go(path, options.max_files, options.start_level)
+    if not options.drain_only:
+        for path in args:
+            updater.go(path, options.max_files, options.start_level)
+    
+    # -- wait for uploads still in progress
+    updater.collect_uploads()
+    
+    # -- send whatever is waiting in the outbox
+    if updater.outbox is not None and not options.queue_only:
+        updater.drain_outbox()
     
     # -- log end time and print some statistics
     updater.log.writeln("Scan finished at %s" % time.ctime())
     updater.log.writeln("Read new headers from %d files." % FileCache.file_count)
+    updater.log.writeln("Made %s." % updater.request_statistics())
  
     # -- flush any output from the updater object
     updater.close()